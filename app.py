@@ -2,12 +2,78 @@
 import streamlit as st
 import json
 import os
+from collections import Counter
 from pathlib import Path
-from src.odyssey_hierarchical_pipeline import OdysseyHierarchicalPipeline
 from dotenv import load_dotenv
 
 load_dotenv()
 
+
+EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+
+
+@st.cache_resource(show_spinner=False)
+def get_embedder():
+    """Load the sentence-transformer once per process"""
+    import torch
+    from sentence_transformers import SentenceTransformer
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    return SentenceTransformer(EMBEDDING_MODEL_NAME, device=device)
+
+
+@st.cache_resource(show_spinner=False)
+def get_generator():
+    """Create the Gemini client once per process"""
+    from src.llm_generator import GeminiGenerator
+    return GeminiGenerator()
+
+
+@st.cache_resource(show_spinner=False)
+def get_pipeline(html_path: str):
+    """Build the pipeline once per html_path and share it across sessions"""
+    # Imported here so the UI renders before torch/faiss/genai are loaded
+    from src.odyssey_hierarchical_pipeline import OdysseyHierarchicalPipeline
+    # Shared models survive a rebuild for a different html_path
+    return OdysseyHierarchicalPipeline(
+        html_path=html_path,
+        embedder=get_embedder(),
+        generator=get_generator()
+    )
+
+
+@st.cache_data(ttl=3600, max_entries=256, show_spinner=False)
+def retrieve_for_question(question: str, k: int, threshold: float, strategy: str, html_path: str,
+                          history: tuple = ()):
+    """Retrieval + prompt for a question; repeat questions skip embedding and search"""
+    return get_pipeline(html_path).prepare_answer(
+        question=question,
+        k=k,
+        threshold=threshold,
+        strategy=strategy,
+        history=list(history)
+    )
+
+
+@st.cache_data(ttl=5, show_spinner=False)
+def file_info(path: str):
+    """(exists, size in KB) for a file; one stat per path every 5 seconds"""
+    p = Path(path)
+    if not p.exists():
+        return False, None
+    return True, p.stat().st_size / 1024
+
+
+@st.cache_data(show_spinner=False)
+def load_hierarchy(path: str, mtime: float):
+    """Load hierarchy JSON and per-level node counts (mtime invalidates the cache)"""
+    with open(path, "r") as f:
+        hierarchy = json.load(f)
+
+    levels = Counter(node.get("level", 0) for node in hierarchy.get("nodes", {}).values())
+
+    return hierarchy, levels
+
+
 # Page config
 st.set_page_config(
     page_title="Odyssey Hierarchical RAG",
@@ -55,9 +121,9 @@ with st.sidebar:
     html_path = st.text_input("HTML file path", "data/raw/odyssey.html")
     
     # Check if file exists
-    if Path(html_path).exists():
+    file_exists, file_size = file_info(html_path)
+    if file_exists:
         st.success(f"Found: {html_path}")
-        file_size = Path(html_path).stat().st_size / 1024
         st.caption(f"File size: {file_size:.1f} KB")
     else:
         st.error(f"File not found: {html_path}")
@@ -88,9 +154,7 @@ with st.sidebar:
         if st.button("Initialize System", type="primary", disabled=not api_key):
             with st.spinner("Building hierarchical RAG system..."):
                 try:
-                    st.session_state.pipeline = OdysseyHierarchicalPipeline(
-                        html_path=html_path
-                    )
+                    st.session_state.pipeline = get_pipeline(html_path)
                     st.session_state.system_ready = True
                     st.success("System ready!")
                     
@@ -122,8 +186,9 @@ with st.sidebar:
     if st.session_state.show_hierarchy and st.session_state.pipeline:
         hierarchy_file = "data/processed/hierarchy.json"
         if Path(hierarchy_file).exists():
-            with open(hierarchy_file, "r") as f:
-                hierarchy = json.load(f)
+            hierarchy, levels = load_hierarchy(
+                hierarchy_file, Path(hierarchy_file).stat().st_mtime
+            )
             
             st.json(hierarchy, expanded=False)
             
@@ -131,11 +196,6 @@ with st.sidebar:
             nodes = hierarchy.get("nodes", {})
             if nodes:
                 st.metric("Total nodes", len(nodes))
-                levels = {}
-                for node_id, node in nodes.items():
-                    level = node.get("level", 0)
-                    levels[level] = levels.get(level, 0) + 1
-                
                 for level, count in sorted(levels.items()):
                     st.caption(f"Level {level} nodes: {count}")
 
@@ -167,41 +227,44 @@ with col4:
 
 st.divider()
 
+def render_message(message):
+    """Render one chat message, with retrieval details for assistant replies"""
+    with st.chat_message(message["role"]):
+        st.markdown(message["content"])
+        
+        # Show metadata for assistant messages
+        if message["role"] == "assistant" and "metadata" in message:
+            metadata = message["metadata"]
+            with st.expander("Retrieval Details"):
+                cols = st.columns(4)
+                with cols[0]:
+                    st.metric("Strategy", metadata.get("strategy", "N/A"))
+                with cols[1]:
+                    st.metric("Type", metadata.get("question_type", "N/A"))
+                with cols[2]:
+                    st.metric("Chunks", metadata.get("chunks_retrieved", 0))
+                with cols[3]:
+                    if metadata.get("avg_similarity") is not None:
+                        st.metric("Avg Similarity", f"{metadata['avg_similarity']:.3f}")
+                
+                # Sources table
+                if metadata.get("sources"):
+                    st.subheader("Retrieved Sources")
+                    for i, source in enumerate(metadata["sources"]):
+                        with st.expander(f"Source {i+1}: {source.get('chunk_type', 'chunk')}"):
+                            st.caption(f"Similarity: {source['similarity']:.3f}")
+                            st.caption(f"Level: {source.get('level', 'N/A')}")
+                            st.caption(f"Has parent: {source.get('has_parent', False)}")
+                            st.caption(f"Children: {source.get('child_count', 0)}")
+                            st.text(source['text_preview'])
+
 # Chat container
 chat_container = st.container()
 
-# Display chat history
+# Display chat history (the only place finished messages are rendered)
 with chat_container:
     for message in st.session_state.messages:
-        with st.chat_message(message["role"]):
-            st.markdown(message["content"])
-            
-            # Show metadata for assistant messages
-            if message["role"] == "assistant" and "metadata" in message:
-                metadata = message["metadata"]
-                with st.expander("Retrieval Details"):
-                    cols = st.columns(4)
-                    with cols[0]:
-                        st.metric("Strategy", metadata.get("strategy", "N/A"))
-                    with cols[1]:
-                        st.metric("Type", metadata.get("question_type", "N/A"))
-                    with cols[2]:
-                        st.metric("Chunks", metadata.get("chunks_retrieved", 0))
-                    with cols[3]:
-                        if metadata.get("sources"):
-                            avg_sim = sum(s["similarity"] for s in metadata["sources"]) / len(metadata["sources"])
-                            st.metric("Avg Similarity", f"{avg_sim:.3f}")
-                    
-                    # Sources table
-                    if metadata.get("sources"):
-                        st.subheader("Retrieved Sources")
-                        for i, source in enumerate(metadata["sources"]):
-                            with st.expander(f"Source {i+1}: {source.get('chunk_type', 'chunk')}"):
-                                st.caption(f"Similarity: {source['similarity']:.3f}")
-                                st.caption(f"Level: {source.get('level', 'N/A')}")
-                                st.caption(f"Has parent: {source.get('has_parent', False)}")
-                                st.caption(f"Children: {source.get('child_count', 0)}")
-                                st.text(source['text_preview'])
+        render_message(message)
 
 # Chat input
 if prompt := st.chat_input("Ask about The Odyssey...", 
@@ -218,98 +281,57 @@ if prompt := st.chat_input("Ask about The Odyssey...",
    
     with st.chat_message("assistant"):
      if not api_key:
-         response = "Please configure your Google API key in the .env file."
+         result = {"answer": "Please configure your Google API key in the .env file."}
          metadata = {}
-         st.markdown(response)
      elif not st.session_state.system_ready:
-         response = "Please initialize the system first using the sidebar button."
+         result = {"answer": "Please initialize the system first using the sidebar button."}
          metadata = {}
-         st.markdown(response)
      else:
-         with st.spinner("Retrieving with hierarchy-aware search..."):
-             try:
-                 pipeline = st.session_state.pipeline
-
-                 # Handle different strategies
-                 if retrieval_strategy != "adaptive":
-                     # For non-adaptive strategies, we'll analyze the question
-                     # but also adjust parameters
-                     question_type = retrieval_strategy  # Use the strategy as question type
-
-                     # Get retrieval parameters for this strategy
-                     retrieval_kwargs = pipeline._get_retrieval_kwargs(
-                         question_type, k_chunks, similarity_threshold
-                     )
-
-                     # Get results
-                     retrieved_results = pipeline.retriever.retrieve_with_context(
-                         query=prompt,
-                         **retrieval_kwargs
-                     )
-
-                     # Format context
-                     context = pipeline._format_context_with_hierarchy(retrieved_results, question_type)
-
-                     # Create prompt
-                     final_prompt = pipeline._create_odyssey_prompt(context, prompt, question_type)
-
-                     # Generate answer
-                     answer = pipeline.generator.generate(final_prompt, max_new_tokens=512)
-
-                     # Prepare sources
-                     sources = []
-                     for result in retrieved_results:
-                         source_info = {
-                             "chunk_id": result.chunk_id,
-                             "similarity": round(result.similarity, 3),
-                             "chunk_type": result.metadata.get("chunk_type", "unknown"),
-                             "level": result.metadata.get("level", "unknown"),
-                             "has_parent": result.parent_text is not None,
-                             "child_count": result.child_count,
-                             "text_preview": result.text[:150] + "..." if len(result.text) > 150 else result.text
-                         }
-                         sources.append(source_info)
-
-                     result = {
-                         "answer": answer.strip(),
-                         "sources": sources,
-                         "question_type": question_type,
-                         "strategy": retrieval_strategy,
-                         "chunks_retrieved": len(retrieved_results)
-                     }
-                 else:
-                     # Use the adaptive strategy
-                     result = pipeline.answer_question(
-                         question=prompt,
-                         k=k_chunks,
-                         threshold=similarity_threshold,
-                         strategy="adaptive"
-                     )
-
-                 # Display answer
-                 st.markdown(result["answer"])
-
-                 # Store metadata for display
-                 metadata = {
-                     "strategy": result.get("strategy", "adaptive"),
-                     "question_type": result.get("question_type", "general"),
-                     "chunks_retrieved": result.get("chunks_retrieved", 0),
-                     "sources": result.get("sources", [])
-                 }
-
-             except Exception as e:
-                    response = f"Error generating response: {str(e)}"
-                    metadata = {}
-                    st.error(response)
-                    result = {"answer": response, "sources": []}
-
-
-    # Add assistant message to history
+         try:
+             pipeline = st.session_state.pipeline
+
+             # Earlier user questions give follow-ups conversational context
+             history = tuple(
+                 m["content"] for m in st.session_state.messages[:-1] if m["role"] == "user"
+             )[-3:]
+
+             # Non-adaptive strategies are used directly as the question type
+             with st.spinner("Retrieving with hierarchy-aware search..."):
+                 result = retrieve_for_question(
+                     prompt, k_chunks, similarity_threshold,
+                     retrieval_strategy, pipeline.html_path, history
+                 )
+
+             # Stream the answer while Gemini generates it
+             final_prompt = result.pop("prompt")
+             if final_prompt is not None:
+                 answer = st.write_stream(
+                     pipeline.generator.stream(final_prompt, max_new_tokens=512)
+                 )
+                 result["answer"] = answer.strip()
+
+             # Store metadata for display
+             metadata = {
+                 "strategy": result.get("strategy", "adaptive"),
+                 "question_type": result.get("question_type", "general"),
+                 "chunks_retrieved": result.get("chunks_retrieved", 0),
+                 "sources": result.get("sources", []),
+                 # Computed once here instead of on every rerun
+                 "avg_similarity": result.get("avg_similarity")
+             }
+
+         except Exception as e:
+             metadata = {}
+             result = {"answer": f"Error generating response: {str(e)}", "sources": []}
+
+
+    # Add assistant message to history and let the history loop render it
     st.session_state.messages.append({
         "role": "assistant", 
         "content": result.get("answer", "No response generated"),
         "metadata": metadata
     })
+    st.rerun()
 
 # Footer
 st.divider()
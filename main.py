@@ -1,17 +1,25 @@
 # main.py
 from fastapi import FastAPI, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, ORJSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
+from functools import lru_cache
+from collections import Counter
+import asyncio
 import json
 import os
+import time
 from pathlib import Path
 from dotenv import load_dotenv
-from src.odyssey_hierarchical_pipeline import OdysseyHierarchicalPipeline
 
 load_dotenv()
 
-app = FastAPI(title="Odyssey Hierarchical RAG API", version="1.0.0")
+app = FastAPI(
+    title="Odyssey Hierarchical RAG API",
+    version="1.0.0",
+    default_response_class=ORJSONResponse
+)
 
 # CORS middleware
 app.add_middleware(
@@ -34,6 +42,7 @@ class QuestionRequest(BaseModel):
     k_chunks: int = 5
     similarity_threshold: float = 0.25
     retrieval_strategy: str = "adaptive"
+    history: Optional[List[str]] = None  # earlier questions in the conversation
 
 class Source(BaseModel):
     chunk_id: str
@@ -50,6 +59,7 @@ class AnswerResponse(BaseModel):
     question_type: str
     chunks_retrieved: int
     sources: List[Source]
+    avg_similarity: Optional[float] = None
     system_stats: Optional[Dict[str, Any]] = None
 
 class SystemStatus(BaseModel):
@@ -59,6 +69,24 @@ class SystemStatus(BaseModel):
     file_exists: bool
     file_size_kb: Optional[float] = None
 
+@lru_cache(maxsize=1)
+def _load_hierarchy(path: str, mtime: float) -> Tuple[Dict[str, Any], Dict[int, int]]:
+    """Load hierarchy JSON and per-level node counts (mtime invalidates the cache)"""
+    with open(path, "r") as f:
+        hierarchy = json.load(f)
+    
+    level_counts = dict(Counter(node.get("level", 0) for node in hierarchy.get("nodes", {}).values()))
+    
+    return hierarchy, level_counts
+
+@lru_cache(maxsize=16)
+def _file_info(path: str, time_bucket: int) -> Tuple[bool, Optional[float]]:
+    """(exists, size in KB) for a file; time_bucket limits it to one stat per window"""
+    p = Path(path)
+    if not p.exists():
+        return False, None
+    return True, p.stat().st_size / 1024
+
 # Dependency to get pipeline
 def get_pipeline():
     global _pipeline
@@ -75,11 +103,7 @@ async def get_status():
     
     # Check default file
     default_path = "data/raw/odyssey.html"
-    file_exists = Path(default_path).exists()
-    file_size = None
-    
-    if file_exists:
-        file_size = Path(default_path).stat().st_size / 1024
+    file_exists, file_size = _file_info(default_path, int(time.monotonic() // 5))
     
     global _pipeline
     return SystemStatus(
@@ -103,6 +127,8 @@ async def initialize_system(request: InitializeRequest):
         raise HTTPException(status_code=404, detail=f"File not found: {request.html_path}")
     
     try:
+        # Imported lazily so the API starts without loading torch/faiss/genai
+        from src.odyssey_hierarchical_pipeline import OdysseyHierarchicalPipeline
         _pipeline = OdysseyHierarchicalPipeline(
             html_path=request.html_path
         )
@@ -119,99 +145,97 @@ async def initialize_system(request: InitializeRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Initialization failed: {str(e)}")
 
-@app.post("/ask")
+@app.post("/ask", response_model=AnswerResponse)
 async def ask_question(request: QuestionRequest, pipeline=Depends(get_pipeline)):
     """Ask a question about The Odyssey"""
     if not pipeline:
         raise HTTPException(status_code=400, detail="System not initialized. Call /initialize first")
     
     try:
-        # Handle different strategies
-        if request.retrieval_strategy != "adaptive":
-            question_type = request.retrieval_strategy
-            
-            # Get retrieval parameters
-            retrieval_kwargs = pipeline._get_retrieval_kwargs(
-                question_type, request.k_chunks, request.similarity_threshold
-            )
-            
-            # Get results
-            retrieved_results = pipeline.retriever.retrieve_with_context(
-                query=request.question,
-                **retrieval_kwargs
-            )
-            
-            # Format context
-            context = pipeline._format_context_with_hierarchy(retrieved_results, question_type)
-            
-            # Create prompt
-            final_prompt = pipeline._create_odyssey_prompt(context, request.question, question_type)
-            
-            # Generate answer
-            answer = pipeline.generator.generate(final_prompt, max_new_tokens=512)
-            
-            # Prepare sources
-            sources = []
-            for result in retrieved_results:
-                source_info = Source(
-                    chunk_id=result.chunk_id,
-                    similarity=round(result.similarity, 3),
-                    chunk_type=result.metadata.get("chunk_type", "unknown"),
-                    level=result.metadata.get("level", "unknown"),
-                    has_parent=result.parent_text is not None,
-                    child_count=result.child_count,
-                    text_preview=result.text[:150] + "..." if len(result.text) > 150 else result.text
-                )
-                sources.append(source_info)
-            
-            result_data = {
-                "answer": answer.strip(),
-                "strategy": request.retrieval_strategy,
-                "question_type": question_type,
-                "chunks_retrieved": len(retrieved_results),
-                "sources": sources
-            }
-        else:
-            # Use adaptive strategy
-            result_data = pipeline.answer_question(
-                question=request.question,
-                k=request.k_chunks,
-                threshold=request.similarity_threshold,
-                strategy="adaptive"
-            )
+        # Non-adaptive strategies are used directly as the question type
+        result_data = await pipeline.answer_question_async(
+            question=request.question,
+            k=request.k_chunks,
+            threshold=request.similarity_threshold,
+            strategy=request.retrieval_strategy,
+            history=request.history
+        )
         
-        return AnswerResponse(
-            **result_data,
-            system_stats={
+        # Sources are already plain dicts; skip re-validating them into models
+        return ORJSONResponse({
+            "answer": result_data["answer"],
+            "strategy": result_data["strategy"],
+            "question_type": result_data["question_type"],
+            "chunks_retrieved": result_data["chunks_retrieved"],
+            "sources": result_data["sources"],
+            "avg_similarity": result_data.get("avg_similarity"),
+            "system_stats": {
                 "chunk_count": len(pipeline.chunks),
                 "strategy_used": request.retrieval_strategy
             }
-        )
+        })
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating response: {str(e)}")
 
+@app.post("/ask/stream")
+async def ask_question_stream(request: QuestionRequest, pipeline=Depends(get_pipeline)):
+    """Ask a question and stream the answer as server-sent events"""
+    if not pipeline:
+        raise HTTPException(status_code=400, detail="System not initialized. Call /initialize first")
+    
+    try:
+        result_data = await pipeline.prepare_answer_async(
+            question=request.question,
+            k=request.k_chunks,
+            threshold=request.similarity_threshold,
+            strategy=request.retrieval_strategy,
+            history=request.history
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error generating response: {str(e)}")
+    
+    final_prompt = result_data.pop("prompt")
+    
+    async def sse_gen():
+        # Sources first so the client can render them while tokens arrive
+        yield f"event: sources\ndata: {json.dumps(result_data['sources'])}\n\n"
+        
+        if final_prompt is None:
+            yield f"data: {json.dumps({'token': result_data['answer']})}\n\n"
+        else:
+            async for token in pipeline.generator.astream(final_prompt, max_new_tokens=512):
+                yield f"data: {json.dumps({'token': token})}\n\n"
+        
+        yield "data: {\"done\": true}\n\n"
+    
+    return StreamingResponse(
+        sse_gen(),
+        media_type="text/event-stream",
+        headers={"X-Accel-Buffering": "no", "Cache-Control": "no-cache"}
+    )
+
 @app.get("/hierarchy")
 async def get_hierarchy():
     """Get document hierarchy structure"""
     hierarchy_file = "data/processed/hierarchy.json"
+    stats_file = "data/processed/hierarchy_with_stats.json"
     if not Path(hierarchy_file).exists():
         raise HTTPException(status_code=404, detail="Hierarchy file not found")
     
-    with open(hierarchy_file, "r") as f:
-        hierarchy = json.load(f)
+    # Serve the prebuilt file as-is when it is up to date with hierarchy.json
+    if Path(stats_file).exists() and Path(stats_file).stat().st_mtime >= Path(hierarchy_file).stat().st_mtime:
+        return FileResponse(stats_file, media_type="application/json")
     
-    # Calculate stats
-    nodes = hierarchy.get("nodes", {})
-    level_counts = {}
-    for node_id, node in nodes.items():
-        level = node.get("level", 0)
-        level_counts[level] = level_counts.get(level, 0) + 1
+    # The first load parses the whole file; keep that read off the event loop
+    hierarchy, level_counts = await asyncio.to_thread(
+        _load_hierarchy, hierarchy_file, Path(hierarchy_file).stat().st_mtime
+    )
     
     return {
         "hierarchy": hierarchy,
         "stats": {
-            "total_nodes": len(nodes),
+            "total_nodes": len(hierarchy.get("nodes", {})),
             "level_counts": level_counts
         }
     }
@@ -225,4 +249,16 @@ async def reset_system():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    if os.getenv("DEV") == "1":
+        uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    else:
+        # The pipeline lives in process memory and /initialize only reaches one
+        # worker, so extra workers are opt-in via WORKERS
+        uvicorn.run(
+            "main:app",
+            host="0.0.0.0",
+            port=8000,
+            workers=int(os.getenv("WORKERS", "1")),
+            loop="uvloop",
+            http="httptools"
+        )
\ No newline at end of file
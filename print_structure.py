@@ -1,23 +1,30 @@
 import os
+import sys
 
 EXCLUDE_DIRS = {"node_modules", "venv", "__pycache__",".git",".vscode"}
 
-def print_tree(root, prefix=""):
+def print_tree(root, prefix="", lines=None):
+    top_level = lines is None
+    if top_level:
+        lines = []
+
     try:
-        entries = sorted(os.listdir(root))
+        # DirEntry caches the file type from the directory read, so no stat per entry
+        with os.scandir(root) as it:
+            entries = sorted((e for e in it if e.name not in EXCLUDE_DIRS), key=lambda e: e.name)
     except PermissionError:
-        return
-
-    entries = [e for e in entries if e not in EXCLUDE_DIRS]
+        entries = []
 
     for i, entry in enumerate(entries):
-        path = os.path.join(root, entry)
         connector = "└── " if i == len(entries) - 1 else "├── "
-        print(prefix + connector + entry)
+        lines.append(prefix + connector + entry.name)
 
-        if os.path.isdir(path):
+        if entry.is_dir(follow_symlinks=False):
             extension = "    " if i == len(entries) - 1 else "│   "
-            print_tree(path, prefix + extension)
+            print_tree(entry.path, prefix + extension, lines)
+
+    if top_level and lines:
+        sys.stdout.write("\n".join(lines) + "\n")
 
 if __name__ == "__main__":
     print_tree(".")
@@ -0,0 +1,75 @@
+# src/batched_retriever.py
+import asyncio
+from typing import List, Optional, Tuple
+
+from .simple_hierarchical_retriever import SimpleHierarchicalRetriever, HierarchicalResult
+
+
+class BatchedRetriever:
+    """
+    Coalesces concurrent retrieval requests into one batched encode + FAISS search.
+
+    Requests arriving within `max_wait` seconds of the first one in a batch
+    (up to `max_batch_size`) share a single model.encode() and index.search().
+    """
+
+    def __init__(
+        self,
+        retriever: SimpleHierarchicalRetriever,
+        max_batch_size: int = 32,
+        max_wait: float = 0.02
+    ):
+        self.retriever = retriever
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    async def submit(self, query: str, **kwargs) -> List[HierarchicalResult]:
+        """Queue a query (retrieve_with_context kwargs) and wait for its results"""
+        if self._worker is None or self._worker.done():
+            # Bind queue and worker to the running event loop on first use
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((query, kwargs, future))
+        return await future
+
+    async def _collect_batch(self) -> List[Tuple[str, dict, asyncio.Future]]:
+        """Wait for one request, then gather more until the window closes"""
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def _run(self) -> None:
+        while True:
+            batch = await self._collect_batch()
+            queries = [query for query, _, _ in batch]
+            kwargs_list = [kwargs for _, kwargs, _ in batch]
+
+            try:
+                # Encoding and search are blocking; run them off the event loop
+                results = await asyncio.to_thread(
+                    self.retriever.retrieve_with_context_batch, queries, kwargs_list
+                )
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, _, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
@@ -1,13 +1,62 @@
 # src/advanced_data_processor.py
-import json
+import multiprocessing
+import os
 import re
+import string
+from concurrent.futures import ProcessPoolExecutor
 from typing import List, Dict, Optional, Tuple
 from dataclasses import dataclass
+import orjson
 from bs4 import BeautifulSoup
 import fitz  # PyMuPDF for PDF processing
 from pathlib import Path
+from sys import intern
 
-@dataclass
+# Section header patterns fused into one alternation, compiled once.
+# The group that matches gives the level; 1.1.1 is tried before 1.1 and 1.
+_SECTION_HEADER_RE = re.compile(
+    r'^(?:'
+    r'(?P<chapter>(?:CHAPTER|Chapter|CHAP\.))\s+(?:[IVXLCDM0-9]+|[A-Z])'  # CHAPTER IV
+    r'|(?P<subsection>\d+\.\d+\.\d+)\s+'  # 1.1.1, 2.3.4, etc.
+    r'|(?P<section>\d+\.\d+)\s+'  # 1.1, 2.3, etc.
+    r'|(?P<number>\d+)\s+'  # 1, 2, 3
+    r'|(?P<letter>[A-Z])\.\s+'  # A., B., C.
+    r'|\((?P<item>[a-z])\)\s+'  # (a), (b), (c)
+    r')'
+)
+# Every header form starts with one of these; other lines skip the regex entirely
+_HEADER_START_CHARS = frozenset(string.ascii_uppercase + string.digits + "(")
+# Pages handled per extraction worker process
+PDF_PAGES_PER_WORKER = 50
+
+_SECTION_LEVELS = {
+    "chapter": 1,
+    "subsection": 3,
+    "section": 2,
+    "number": 2,
+    "letter": 3,
+    "item": 4,
+}
+
+
+def _extract_page_lines(path: str, page_range: Tuple[int, int]) -> List[List[str]]:
+    """Return the non-empty text lines of each page in [start, stop) (runs in a worker)"""
+    pages = []
+    with fitz.open(path) as doc:
+        for page_num in range(*page_range):
+            # MuPDF segments the page into (x0, y0, x1, y1, text, block_no, block_type).
+            # A block can hold a header together with the body lines around it, so
+            # blocks are flattened to lines and every line is checked for a header.
+            blocks = doc.load_page(page_num).get_text("blocks")
+            pages.append([
+                line
+                for block in blocks if block[6] == 0  # Skip image blocks
+                for line in block[4].split('\n') if line.strip()
+            ])
+    return pages
+
+
+@dataclass(slots=True)
 class DocumentNode:
     """Represents a node in the document hierarchy"""
     id: str
@@ -32,37 +81,49 @@ class AdvancedDataProcessor:
         self.nodes: Dict[str, DocumentNode] = {}
         self.root_nodes: List[str] = []
         
-        # Regex patterns for identifying logical sections
-        self.section_patterns = [
-            (r'^(CHAPTER|Chapter|CHAP\.)\s+([IVXLCDM0-9]+|[A-Z])', 1),
-            (r'^(\d+\.\d+)\s+', 2),  # 1.1, 2.3, etc.
-            (r'^(\d+\.\d+\.\d+)\s+', 3),  # 1.1.1, 2.3.4, etc.
-            (r'^(\d+)\s+', 2),  # 1, 2, 3
-            (r'^([A-Z])\.\s+', 3),  # A., B., C.
-            (r'^\(([a-z])\)\s+', 4),  # (a), (b), (c)
-        ]
-        
     def _determine_level(self, text: str) -> Tuple[Optional[str], int]:
         """Identify if text is a section header and determine its level"""
-        for pattern, level in self.section_patterns:
-            match = re.match(pattern, text.strip())
-            if match:
-                return match.group(1), level
+        text = text.strip()
+        if not text or (text[0] not in _HEADER_START_CHARS and not text[0].isdecimal()):
+            return None, 0  # Regular paragraph
+        match = _SECTION_HEADER_RE.match(text)
+        if match:
+            return match.group(match.lastgroup), _SECTION_LEVELS[match.lastgroup]
         return None, 0  # Regular paragraph
     
-    def process_pdf(self) -> List[DocumentNode]:
+    def _extract_pdf_pages(self, max_workers: Optional[int] = None) -> List[List[str]]:
+        """Extract text lines for every page, fanning page ranges out to worker processes"""
+        with fitz.open(self.content_path) as doc:
+            page_count = len(doc)
+        
+        # Worker start-up only pays off for long documents: one worker per
+        # PDF_PAGES_PER_WORKER pages, and short PDFs are read in-process
+        workers = max(1, min(max_workers or os.cpu_count() or 1, 4, page_count // PDF_PAGES_PER_WORKER))
+        if workers == 1:
+            return _extract_page_lines(self.content_path, (0, page_count))
+        
+        step = -(-page_count // workers)  # Ceiling division
+        ranges = [(start, min(start + step, page_count)) for start in range(0, page_count, step)]
+        
+        pages = []
+        # Spawned workers import only this module, instead of forking a parent that
+        # may already hold torch/FAISS state
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            # map() preserves page order
+            for chunk in executor.map(_extract_page_lines, [self.content_path] * len(ranges), ranges):
+                pages.extend(chunk)
+        return pages
+    
+    def process_pdf(self, max_workers: Optional[int] = None) -> List[DocumentNode]:
         """Process PDF with logical segmentation"""
-        doc = fitz.open(self.content_path)
+        pages = self._extract_pdf_pages(max_workers)
         nodes = []
+        id_to_node: Dict[str, DocumentNode] = {}  # O(1) parent lookup while building
         current_hierarchy = [None] * 5  # Track current nodes at each level
         node_id = 0
         
-        for page_num in range(len(doc)):
-            page = doc.load_page(page_num)
-            text = page.get_text()
-            
-            # Split by potential section headers
-            lines = text.split('\n')
+        # Hierarchy stitching stays serial so current_hierarchy follows page order
+        for page_num, lines in enumerate(pages):
             current_text = []
             
             for line in lines:
@@ -84,6 +145,7 @@ class AdvancedDataProcessor:
                             }
                         )
                         nodes.append(para_node)
+                        id_to_node[para_node.id] = para_node
                         node_id += 1
                         current_text = []
                     
@@ -95,7 +157,7 @@ class AdvancedDataProcessor:
                         parent_id=current_hierarchy[level-1] if level > 1 else None,
                         children_ids=[],
                         metadata={
-                            "section_id": section_id,
+                            "section_id": intern(section_id),  # few distinct ids, many nodes
                             "page": page_num,
                             "type": "section"
                         }
@@ -109,10 +171,10 @@ class AdvancedDataProcessor:
                     
                     # Add to parent's children
                     if section_node.parent_id:
-                        parent = next(n for n in nodes if n.id == section_node.parent_id)
-                        parent.children_ids.append(section_node.id)
+                        id_to_node[section_node.parent_id].children_ids.append(section_node.id)
                     
                     nodes.append(section_node)
+                    id_to_node[section_node.id] = section_node
                     node_id += 1
                     
                     # If this is a root-level section
@@ -121,8 +183,7 @@ class AdvancedDataProcessor:
                         
                 else:
                     # Regular text line
-                    if line.strip():
-                        current_text.append(line.strip())
+                    current_text.append(line.strip())
             
             # Add remaining text from page
             if current_text:
@@ -138,10 +199,11 @@ class AdvancedDataProcessor:
                     }
                 )
                 nodes.append(para_node)
+                id_to_node[para_node.id] = para_node
                 node_id += 1
         
         # Store nodes in dictionary for easy lookup
-        self.nodes = {node.id: node for node in nodes}
+        self.nodes = id_to_node
         return nodes
     
     def process_html(self) -> List[DocumentNode]:
@@ -159,11 +221,33 @@ class AdvancedDataProcessor:
             'section': 2, 'article': 1, 'div': 3
         }
         
-        def process_element(el, current_hierarchy):
-            nonlocal node_id
+        # Preorder walk with an explicit stack; current_hierarchy is shared state,
+        # updated as structural elements are visited in document order
+        stack = [soup.body or soup]
+        while stack:
+            el = stack.pop()
+            
+            if not hasattr(el, 'name'):
+                if isinstance(el, str) and el.strip():
+                    # Text node - create paragraph
+                    node = DocumentNode(
+                        id=f"para_{node_id}",
+                        text=el.strip(),
+                        level=4,
+                        parent_id=current_hierarchy[3] or current_hierarchy[2] or current_hierarchy[1],
+                        children_ids=[],
+                        metadata={
+                            "type": "paragraph",
+                            "tag": "text"
+                        }
+                    )
+                    nodes.append(node)
+                    self.nodes[node.id] = node
+                    node_id += 1
+                continue
             
             if el.name in ['style', 'script', 'meta', 'link', 'head']:
-                return current_hierarchy
+                continue
             
             # Check if element is a structural tag
             if el.name in tag_to_level:
@@ -179,7 +263,7 @@ class AdvancedDataProcessor:
                         parent_id=current_hierarchy[level-1] if level > 1 else None,
                         children_ids=[],
                         metadata={
-                            "tag": el.name,
+                            "tag": intern(el.name),  # html.parser allocates a new name per tag
                             "type": "structural"
                         }
                     )
@@ -201,31 +285,10 @@ class AdvancedDataProcessor:
                     if level == 1:
                         self.root_nodes.append(node.id)
             
-            # Process children
+            # Process children, first child on top of the stack
             if hasattr(el, 'children'):
-                for child in el.children:
-                    if hasattr(child, 'name'):
-                        current_hierarchy = process_element(child, current_hierarchy)
-                    elif isinstance(child, str) and child.strip():
-                        # Text node - create paragraph
-                        node = DocumentNode(
-                            id=f"para_{node_id}",
-                            text=child.strip(),
-                            level=4,
-                            parent_id=current_hierarchy[3] or current_hierarchy[2] or current_hierarchy[1],
-                            children_ids=[],
-                            metadata={
-                                "type": "paragraph",
-                                "tag": "text"
-                            }
-                        )
-                        nodes.append(node)
-                        self.nodes[node.id] = node
-                        node_id += 1
-            
-            return current_hierarchy
+                stack.extend(reversed(list(el.children)))
         
-        process_element(soup.body or soup, current_hierarchy)
         return nodes
     
     def create_logical_chunks(self) -> List[Dict]:
@@ -272,26 +335,32 @@ class AdvancedDataProcessor:
     
     def _get_subtree_text(self, node_id: str, max_depth: int = 2) -> str:
         """Get text from a node and its children up to certain depth"""
-        node = self.nodes[node_id]
-        texts = [node.text]
+        texts = []
+        stack = [(node_id, 0)]
         
-        if max_depth > 0 and node.children_ids:
-            for child_id in node.children_ids[:10]:  # Limit children
-                child_text = self._get_subtree_text(child_id, max_depth - 1)
-                if child_text:
-                    texts.append(child_text)
+        # Preorder walk with an explicit stack; one join at the end
+        while stack:
+            current_id, depth = stack.pop()
+            node = self.nodes[current_id]
+            if node.text:
+                texts.append(node.text)
+            
+            if depth < max_depth and node.children_ids:
+                # Push in reverse so the first child is visited first
+                for child_id in reversed(node.children_ids[:10]):  # Limit children
+                    stack.append((child_id, depth + 1))
         
         return "\n\n".join(texts)
     
     def save_hierarchy(self, output_path: str):
-        """Save hierarchical structure to JSON"""
-        hierarchy = {
-            "nodes": {k: self._node_to_dict(v) for k, v in self.nodes.items()},
-            "root_nodes": self.root_nodes
-        }
-        
-        with open(output_path, "w", encoding="utf-8") as f:
-            json.dump(hierarchy, f, indent=2, ensure_ascii=False)
+        """Save hierarchical structure to JSON, streamed node by node"""
+        with open(output_path, "wb") as f:
+            f.write(b'{"nodes":{')
+            for i, (node_id, node) in enumerate(self.nodes.items()):
+                if i:
+                    f.write(b',')
+                f.write(orjson.dumps(node_id) + b':' + orjson.dumps(self._node_to_dict(node)))
+            f.write(b'},"root_nodes":' + orjson.dumps(self.root_nodes) + b'}')
     
     def _node_to_dict(self, node: DocumentNode) -> Dict:
         return {
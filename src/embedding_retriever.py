@@ -1,18 +1,36 @@
 # src/embedding_retriever.py
 
 import json
+import threading
+from collections import OrderedDict
+from pathlib import Path
 from typing import List, Dict, Tuple, Optional
 
 import faiss
+import ijson
 import numpy as np
+import orjson
 from sentence_transformers import SentenceTransformer
+from .faiss_threads import configure_faiss_threads
+
+# HNSW graph parameters: neighbours per node, build-time and query-time beam widths
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+
+QUERY_CACHE_SIZE = 1024
 
 
 class EmbeddingRetriever:
     def __init__(self, model_name: str = "sentence-transformers/all-MiniLM-L6-v2"):
+        configure_faiss_threads()
         self.model = SentenceTransformer(model_name)
-        self.index: Optional[faiss.IndexFlatIP] = None
+        self.index: Optional[faiss.Index] = None
+        self._exact_index: Optional[faiss.IndexFlatIP] = None
+        self.embeddings: Optional[np.ndarray] = None  # float32 rows; the index only holds int8 codes
         self.chunks: List[Dict] = []
+        self._query_cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._query_cache_lock = threading.Lock()  # retrieval may run in worker threads
 
         self.dimension = int(self.model.get_sentence_embedding_dimension())
 
@@ -21,22 +39,115 @@ class EmbeddingRetriever:
         faiss.normalize_L2(x)
 
     @staticmethod
-    def _search(index: faiss.IndexFlatIP, x: np.ndarray, k: int):
+    def _search(index: faiss.Index, x: np.ndarray, k: int):
         return index.search(x, k)
 
+    def _new_index(self) -> faiss.Index:
+        """
+        Approximate index; inner product on normalized rows is cosine similarity.
+        Vectors are stored as int8 (4x smaller than float32), so it must be trained before add.
+        """
+        index = faiss.IndexHNSWSQ(
+            self.dimension, faiss.ScalarQuantizer.QT_8bit, HNSW_M, faiss.METRIC_INNER_PRODUCT
+        )
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+        return index
+
+    def _build_index(self, embeddings_np: np.ndarray) -> None:
+        """Train the quantizer ranges on the corpus and add it to a fresh index"""
+        self.index = self._new_index()
+        self._exact_index = None
+        embeddings_np = np.ascontiguousarray(embeddings_np, dtype=np.float32)
+        self.embeddings = embeddings_np
+        if len(embeddings_np):
+            self.index.train(embeddings_np)
+            self.index.add(embeddings_np)
+
+    def _get_exact_index(self) -> faiss.Index:
+        """Brute-force index over the original float32 embeddings, built on first use"""
+        if isinstance(self.index, faiss.IndexFlat):
+            return self.index
+        if self._exact_index is None or self._exact_index.ntotal != self.index.ntotal:
+            if self.embeddings is not None and len(self.embeddings) == self.index.ntotal:
+                vectors = np.ascontiguousarray(self.embeddings, dtype=np.float32)
+            else:
+                # Index saved without embeddings.npy: only the dequantized int8 vectors exist
+                vectors = self.index.reconstruct_n(0, self.index.ntotal)
+            exact = faiss.IndexFlatIP(self.dimension)
+            exact.add(vectors)
+            self._exact_index = exact
+        return self._exact_index
+
+    def _encode(self, texts: List[str], batch_size: int = 32, show_progress_bar: bool = False) -> np.ndarray:
+        """Encode texts to L2-normalized float32 rows (normalization happens inside encode)"""
+        embeddings = self.model.encode(
+            texts,
+            batch_size=batch_size,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=show_progress_bar,
+        )
+        return embeddings.astype(np.float32, copy=False)
+
+    def _embed_query(self, query: str) -> np.ndarray:
+        """Normalized (1, d) query embedding, served from a small LRU of recent queries"""
+        with self._query_cache_lock:
+            cached = self._query_cache.get(query)
+            if cached is not None:
+                self._query_cache.move_to_end(query)
+                return cached
+
+        query_np = self._encode([query])
+        query_np.setflags(write=False)  # shared between callers
+        with self._query_cache_lock:
+            self._query_cache[query] = query_np
+            if len(self._query_cache) > QUERY_CACHE_SIZE:
+                self._query_cache.popitem(last=False)
+        return query_np
+
+    def clear_query_cache(self) -> None:
+        with self._query_cache_lock:
+            self._query_cache.clear()
+
 
     def create_embeddings(self, chunks: List[Dict]) -> np.ndarray:
         self.chunks = chunks
         texts = [chunk["text"] for chunk in chunks]
 
-        embeddings = self.model.encode(texts, show_progress_bar=True)
-        embeddings_np = np.asarray(embeddings, dtype=np.float32)
+        embeddings_np = self._encode(texts, batch_size=128, show_progress_bar=True)
 
-        self._normalize(embeddings_np)
+        self._build_index(embeddings_np)
 
-        self.index = faiss.IndexFlatIP(self.dimension)
-        self.index.add(embeddings_np)
+        return embeddings_np
 
+    def create_embeddings_from_path(self, chunks_path: str, batch_size: int = 64) -> np.ndarray:
+        """
+        Stream chunks from a JSON array on disk and embed them batch by batch,
+        so parsing overlaps encoding and the raw JSON is never loaded whole.
+        The index is built once at the end, since the quantizer trains on the full corpus.
+        """
+        self.chunks = []
+        batches: List[np.ndarray] = []
+        texts: List[str] = []
+
+        with open(chunks_path, "rb") as f:
+            for chunk in ijson.items(f, "item", use_float=True):
+                self.chunks.append(chunk)
+                texts.append(chunk["text"])
+                if len(texts) == batch_size:
+                    batches.append(self._encode(texts, batch_size=batch_size))
+                    texts = []
+
+        if texts:
+            batches.append(self._encode(texts, batch_size=batch_size))
+
+        if batches:
+            embeddings_np = np.vstack(batches)
+        else:
+            embeddings_np = np.empty((0, self.dimension), dtype=np.float32)
+
+        self._build_index(embeddings_np)
         return embeddings_np
 
     def save_index(self, index_path: str, chunks_path: str) -> None:
@@ -44,12 +155,25 @@ class EmbeddingRetriever:
             raise RuntimeError("No FAISS index to save.")
 
         faiss.write_index(self.index, f"{index_path}/index.faiss")
-
-        with open(chunks_path, "w", encoding="utf-8") as f:
-            json.dump(self.chunks, f, indent=2, ensure_ascii=False)
+        if self.embeddings is not None:
+            # Unquantized rows for exact search after a reload
+            np.save(f"{index_path}/embeddings.npy", self.embeddings)
+
+        # Stream chunk by chunk so the whole file is never held as one string
+        with open(chunks_path, "wb") as f:
+            f.write(b"[")
+            for i, chunk in enumerate(self.chunks):
+                if i:
+                    f.write(b",\n")
+                f.write(orjson.dumps(chunk, option=orjson.OPT_SERIALIZE_NUMPY))
+            f.write(b"]")
 
     def load_index(self, index_path: str, chunks_path: str) -> None:
         self.index = faiss.read_index(f"{index_path}/index.faiss")
+        self._exact_index = None
+
+        embeddings_path = Path(f"{index_path}/embeddings.npy")
+        self.embeddings = np.load(embeddings_path, mmap_mode="r") if embeddings_path.exists() else None
 
         with open(chunks_path, "r", encoding="utf-8") as f:
             self.chunks = json.load(f)
@@ -60,22 +184,54 @@ class EmbeddingRetriever:
         query: str,
         k: int = 5,
         threshold: float = 0.3,
+        exact: bool = False,
     ) -> Tuple[List[Dict], List[float]]:
+        """
+        Top-k chunks above threshold; exact=True scans the unquantized float32
+        embeddings by brute force, as ground truth for the HNSW/int8 results
+        """
 
         if self.index is None:
             raise RuntimeError("FAISS index not initialized.")
 
-        query_embedding = self.model.encode([query])
-        query_np = np.asarray(query_embedding, dtype=np.float32)
+        query_np = self._embed_query(query)
 
-        self._normalize(query_np)
+        index = self._get_exact_index() if exact else self.index
+        scores, indices = self._search(index, query_np, k)
 
-        scores, indices = self._search(self.index, query_np, k)
+        return self._package_results(scores[0], indices[0], threshold)
 
+    def retrieve_batch(
+        self,
+        queries: List[str],
+        k: int = 5,
+        threshold: float = 0.3,
+        exact: bool = False,
+    ) -> List[Tuple[List[Dict], List[float]]]:
+        """retrieve() for many queries with one encode and one (Nq, k) index search"""
+
+        if self.index is None:
+            raise RuntimeError("FAISS index not initialized.")
+        if not queries:
+            return []
+
+        queries_np = self._encode(queries, batch_size=64)
+
+        index = self._get_exact_index() if exact else self.index
+        scores, indices = self._search(index, queries_np, k)
+
+        return [
+            self._package_results(scores_row, indices_row, threshold)
+            for scores_row, indices_row in zip(scores, indices)
+        ]
+
+    def _package_results(
+        self, scores_row: np.ndarray, indices_row: np.ndarray, threshold: float
+    ) -> Tuple[List[Dict], List[float]]:
         results: List[Dict] = []
         similarities: List[float] = []
 
-        for idx, score in zip(indices[0], scores[0]):
+        for idx, score in zip(indices_row, scores_row):
             if idx == -1 or score < threshold:
                 continue
 
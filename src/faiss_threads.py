@@ -0,0 +1,21 @@
+# src/faiss_threads.py
+import os
+import threading
+
+import faiss
+
+_lock = threading.Lock()
+_configured = False
+
+
+def configure_faiss_threads() -> None:
+    """
+    Set the OpenMP thread count FAISS search/add runs on, once per process.
+    Uses half the cores by default (FAISS_THREADS overrides); later calls are no-ops.
+    """
+    global _configured
+    with _lock:
+        if _configured:
+            return
+        faiss.omp_set_num_threads(int(os.getenv("FAISS_THREADS", max(1, (os.cpu_count() or 2) // 2))))
+        _configured = True
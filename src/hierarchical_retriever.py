@@ -1,12 +1,23 @@
 import json
+import threading
 import numpy as np
+import orjson
 from typing import List, Dict, Tuple, Optional
 import faiss
 from sentence_transformers import SentenceTransformer
-from collections import defaultdict
-import networkx as nx
-from dataclasses import dataclass
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass, field
+from heapq import nlargest
+from operator import itemgetter
 from pathlib import Path
+from .faiss_threads import configure_faiss_threads
+
+# HNSW graph parameters: neighbours per node, build-time and query-time beam widths
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+
+QUERY_CACHE_SIZE = 1024
 
 @dataclass
 class RetrievalResult:
@@ -18,20 +29,35 @@ class RetrievalResult:
     parent_chunks: List[Dict]
     child_chunks: List[Dict]
     depth: int
+    text_preview: str = ""
+    # Context-line previews of the first two parents and the children, materialized once here
+    parent_previews: List[str] = field(default_factory=list)
+    child_previews: List[str] = field(default_factory=list)
 
 
 class HierarchicalRetriever:
     """TreeRAG-inspired hierarchical retriever"""
     
     def __init__(self, model_name: str = "sentence-transformers/all-MiniLM-L6-v2"):
+        configure_faiss_threads()
+        self.model_name = model_name
         self.model = SentenceTransformer(model_name)
-        self.flat_index: Optional[faiss.IndexFlatIP] = None
-        self.graph = nx.DiGraph()
+        self.flat_index: Optional[faiss.Index] = None
+        self.children: Dict[str, List[str]] = defaultdict(list)
         self.chunks: List[Dict] = []
         self.chunk_map: Dict[str, Dict] = {}
         self.level_indices = {}
         self.level_chunks = defaultdict(list)
+        self.id_to_idx: Dict[str, int] = {}
+        self.parent_idx: Optional[np.ndarray] = None  # row of each chunk's parent, -1 for none
+        self.chunk_level: Optional[np.ndarray] = None  # level of each row in flat_index
+        self.embeddings: Optional[np.ndarray] = None  # normalized rows of flat_index
+        self.preview_100: List[str] = []
+        self.preview_150: List[str] = []
+        self.text_previews: List[str] = []
         self.dimension = self.model.get_sentence_embedding_dimension()
+        self._query_cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._query_cache_lock = threading.Lock()  # retrieval may run in worker threads
 
     # -------------------
     # Core Utilities
@@ -41,22 +67,56 @@ class HierarchicalRetriever:
         faiss.normalize_L2(x)
 
     @staticmethod
-    def _search(index: faiss.IndexFlatIP, x: np.ndarray, k: int):
+    def _search(index: faiss.Index, x: np.ndarray, k: int):
         return index.search(x, k)
 
+    def _new_index(self) -> faiss.Index:
+        """Approximate index; inner product on normalized rows is cosine similarity"""
+        index = faiss.IndexHNSWFlat(self.dimension, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+        return index
+
+    def _encode(self, texts: List[str], batch_size: int = 32, show_progress_bar: bool = False) -> np.ndarray:
+        """Encode texts to L2-normalized float32 rows (normalization happens inside encode)"""
+        embeddings = self.model.encode(
+            texts,
+            batch_size=batch_size,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=show_progress_bar,
+        )
+        return embeddings.astype(np.float32, copy=False)
+
+    def _embed_query(self, query: str) -> np.ndarray:
+        """Normalized (1, d) query embedding, served from a small LRU of recent queries"""
+        with self._query_cache_lock:
+            cached = self._query_cache.get(query)
+            if cached is not None:
+                self._query_cache.move_to_end(query)
+                return cached
+
+        query_np = self._encode([query])
+        query_np.setflags(write=False)  # shared between callers
+        with self._query_cache_lock:
+            self._query_cache[query] = query_np
+            if len(self._query_cache) > QUERY_CACHE_SIZE:
+                self._query_cache.popitem(last=False)
+        return query_np
+
+    def clear_query_cache(self) -> None:
+        with self._query_cache_lock:
+            self._query_cache.clear()
+
     @staticmethod
     def _merge_results(results1: List[Tuple], results2: List[Tuple], k: int) -> List[Tuple]:
-        merged = results1 + results2
-        seen = set()
-        unique_results = []
-        for chunk, sim in sorted(merged, key=lambda x: x[1], reverse=True):
+        # Keep each chunk's best score, then partial-sort for the top k
+        best: Dict[str, Tuple] = {}
+        for chunk, sim in results1 + results2:
             chunk_id = chunk["chunk_id"]
-            if chunk_id not in seen:
-                seen.add(chunk_id)
-                unique_results.append((chunk, sim))
-            if len(unique_results) >= k * 2:
-                break
-        return unique_results[:k]
+            if chunk_id not in best or sim > best[chunk_id][1]:
+                best[chunk_id] = (chunk, sim)
+        return nlargest(k, best.values(), key=itemgetter(1))
 
     # -------------------
     # Hierarchy Construction
@@ -64,37 +124,77 @@ class HierarchicalRetriever:
     def build_hierarchy(self, chunks: List[Dict]):
         self.chunks = chunks
         self.chunk_map = {chunk["chunk_id"]: chunk for chunk in chunks}
+        # Row-aligned previews for context/source formatting, sliced once here instead of
+        # per request; kept off the chunk dicts so saved and returned chunks are unchanged
+        self.preview_100 = [chunk["text"][:100] for chunk in chunks]
+        self.preview_150 = [chunk["text"][:150] for chunk in chunks]
+        self.text_previews = [
+            chunk["text"][:200] + "..." if len(chunk["text"]) > 200 else chunk["text"]
+            for chunk in chunks
+        ]
         for chunk in chunks:
-            self.graph.add_node(chunk["chunk_id"], **chunk["metadata"])
             parent_id = chunk["metadata"].get("parent_id")
             if parent_id and parent_id in self.chunk_map:
-                self.graph.add_edge(parent_id, chunk["chunk_id"])
+                self.children[parent_id].append(chunk["chunk_id"])
             level = chunk["metadata"].get("level", 0)
             self.level_chunks[level].append(chunk)
 
+        # Row-aligned arrays so hierarchy walks are integer indexing, not dict lookups
+        self.id_to_idx = {chunk["chunk_id"]: i for i, chunk in enumerate(chunks)}
+        self.parent_idx = np.fromiter(
+            (self.id_to_idx.get(c["metadata"].get("parent_id"), -1) for c in chunks),
+            dtype=np.int32, count=len(chunks)
+        )
+        self.chunk_level = np.fromiter(
+            (c["metadata"].get("level", 0) for c in chunks), dtype=np.int8, count=len(chunks)
+        )
+
     def create_multi_level_embeddings(self, chunks: List[Dict]):
         self.build_hierarchy(chunks)
+
+        # Encode every chunk once; the level indices are row slices of the flat embeddings
+        all_texts = [c["text"] for c in chunks]
+        all_embeddings = self._encode(all_texts, batch_size=128, show_progress_bar=True)
+        self.embeddings = np.ascontiguousarray(all_embeddings, dtype=np.float32)
+        self.flat_index = self._new_index()
+        self.flat_index.add(self.embeddings)
+        self._build_level_indices()
+
+        return self.embeddings
+
+    def _build_level_indices(self):
+        positions = {id(c): i for i, c in enumerate(self.chunks)}
         for level, lvl_chunks in self.level_chunks.items():
-            texts = [c["text"] for c in lvl_chunks]
-            embeddings = np.asarray(self.model.encode(texts, show_progress_bar=False), dtype=np.float32)
-            self._normalize(embeddings)
-            index = faiss.IndexFlatIP(self.dimension)
+            rows = np.fromiter((positions[id(c)] for c in lvl_chunks), dtype=np.int64, count=len(lvl_chunks))
+            embeddings = self.embeddings[rows]
+            index = self._new_index()
             index.add(embeddings)
             self.level_indices[level] = {"index": index, "chunks": lvl_chunks, "embeddings": embeddings}
 
-        all_texts = [c["text"] for c in chunks]
-        all_embeddings = np.asarray(self.model.encode(all_texts, show_progress_bar=True), dtype=np.float32)
-        self._normalize(all_embeddings)
-        self.flat_index = faiss.IndexFlatIP(self.dimension)
-        self.flat_index.add(all_embeddings)
-        return all_embeddings
+    # -------------------
+    # Persistence
+    # -------------------
+    def save_index(self, index_dir: str):
+        """Write chunks, embeddings and the flat index; level indices are rebuilt from the embeddings on load"""
+        if self.flat_index is None:
+            raise RuntimeError("No index to save")
+        Path(index_dir).mkdir(parents=True, exist_ok=True)
+        faiss.write_index(self.flat_index, f"{index_dir}/index.faiss")
+        np.save(f"{index_dir}/embeddings.npy", self.embeddings)
+        Path(f"{index_dir}/chunks.json").write_bytes(orjson.dumps(self.chunks))
+
+    def load_index(self, index_dir: str):
+        """Restore a retriever written by save_index without re-encoding anything"""
+        self.build_hierarchy(orjson.loads(Path(f"{index_dir}/chunks.json").read_bytes()))
+        self.embeddings = np.load(f"{index_dir}/embeddings.npy")
+        self.flat_index = faiss.read_index(f"{index_dir}/index.faiss")
+        self._build_level_indices()
 
     # -------------------
     # Hierarchical Retrieval
     # -------------------
     def hierarchical_retrieve(self, query: str, k: int = 5, threshold: float = 0.3, strategy: str = "hybrid"):
-        query_embedding = np.asarray(self.model.encode([query]), dtype=np.float32)
-        self._normalize(query_embedding)
+        query_embedding = self._embed_query(query)
         results = []
 
         if strategy == "top_down":
@@ -102,9 +202,7 @@ class HierarchicalRetriever:
         elif strategy == "bottom_up":
             results = self.bottom_up_retrieval(query_embedding, k, threshold)
         else:
-            top_down = self.top_down_retrieval(query_embedding, k//2, threshold)
-            bottom_up = self.bottom_up_retrieval(query_embedding, k//2, threshold)
-            results = self._merge_results(top_down, bottom_up, k)
+            results = self.hybrid_retrieval(query_embedding, k, threshold)
 
         enriched = [self.enrich_with_hierarchy(chunk, sim) for chunk, sim in results]
         return enriched
@@ -118,7 +216,7 @@ class HierarchicalRetriever:
                 if idx != -1 and score >= threshold:
                     chunk = index_info["chunks"][idx]
                     results.append((chunk, float(score)))
-        return sorted(results, key=lambda x: x[1], reverse=True)[:k]
+        return nlargest(k, results, key=itemgetter(1))
 
     def bottom_up_retrieval(self, query_embedding: np.ndarray, k: int, threshold: float):
         results = []
@@ -129,24 +227,49 @@ class HierarchicalRetriever:
                 if idx != -1 and score >= threshold:
                     chunk = index_info["chunks"][idx]
                     results.append((chunk, float(score)))
-        return sorted(results, key=lambda x: x[1], reverse=True)[:k]
+        return nlargest(k, results, key=itemgetter(1))
+
+    def hybrid_retrieval(self, query_embedding: np.ndarray, k: int, threshold: float):
+        """Top-down and bottom-up candidates from a single flat search, split by chunk level"""
+        levels = sorted(self.level_indices.keys())
+        top_levels = levels[:3]
+        bottom_levels = levels[::-1][:2]
+
+        scores, indices = self._search(self.flat_index, query_embedding, min(k * 8, len(self.chunks)))
+        scores, indices = scores[0], indices[0]
+        keep = (indices != -1) & (scores >= threshold)
+        scores, indices = scores[keep], indices[keep]
+        chunk_levels = self.chunk_level[indices]
+
+        # Search results are already sorted by score, so the first k//2 of each side are its top hits
+        half = k // 2
+        top_mask = np.isin(chunk_levels, top_levels)
+        bottom_mask = np.isin(chunk_levels, bottom_levels)
+        top_down = [(self.chunks[i], float(s)) for i, s in zip(indices[top_mask][:half], scores[top_mask][:half])]
+        bottom_up = [(self.chunks[i], float(s)) for i, s in zip(indices[bottom_mask][:half], scores[bottom_mask][:half])]
+        return self._merge_results(top_down, bottom_up, k)
 
     def enrich_with_hierarchy(self, chunk: Dict, similarity: float) -> RetrievalResult:
         chunk_id = chunk["chunk_id"]
-        parent_chunks, depth = [], 0
-        current = chunk["metadata"].get("parent_id")
-        while current and current in self.chunk_map:
-            parent_chunks.append(self.chunk_map[current])
-            current = self.chunk_map[current]["metadata"].get("parent_id")
-            depth += 1
-
-        child_chunks = [self.chunk_map[cid] for cid in self.graph.successors(chunk_id) if cid in self.chunk_map]
+        parent_rows = []
+        current = self.id_to_idx.get(chunk["metadata"].get("parent_id"), -1)
+        while current != -1:
+            parent_rows.append(current)
+            current = self.parent_idx[current]
+        parent_chunks = [self.chunks[row] for row in parent_rows]
+        depth = len(parent_chunks)
+
+        child_rows = [self.id_to_idx[cid] for cid in self.children.get(chunk_id, ())[:3]]
+        child_chunks = [self.chunks[row] for row in child_rows]
         return RetrievalResult(
             chunk_id=chunk_id,
             text=chunk["text"],
             similarity=similarity,
             metadata=chunk["metadata"],
             parent_chunks=parent_chunks,
-            child_chunks=child_chunks[:3],
-            depth=depth
+            child_chunks=child_chunks,
+            depth=depth,
+            text_preview=self.text_previews[self.id_to_idx[chunk_id]],
+            parent_previews=[self.preview_100[row] for row in parent_rows[:2]],
+            child_previews=[self.preview_150[row] for row in child_rows]
         )
@@ -1,16 +1,75 @@
 # src/html_hierarchical_processor.py
-import json
 import re
-from typing import List, Dict, Optional, Tuple
+from collections import Counter
+from typing import BinaryIO, Iterator, List, Dict, Optional, Tuple
 from dataclasses import dataclass
-from bs4 import BeautifulSoup
-import nltk
-from nltk.tokenize import sent_tokenize
+import numpy as np
+import orjson
+from lxml import etree
 from pathlib import Path
+from sys import intern
 
-nltk.download("punkt", quiet=True)
+# Elements that become nodes; everything else is only parsed through
+_CONTENT_TAGS = ("h1", "h2", "h3", "h4", "h5", "h6", "p", "div")
+_SKIP_TEXT_TAGS = frozenset({"script", "style"})
 
-@dataclass
+
+def _element_text(element) -> str:
+    """
+    Text of an lxml element, matching BeautifulSoup's get_text(" ", strip=True):
+    every text/tail string stripped and space-joined, without comments, scripts or styles
+    """
+    # Common case: no script/style below, so lxml's C-level itertext (which already
+    # skips comments) yields exactly the strings we want
+    if next(element.iter(*_SKIP_TEXT_TAGS), None) is None:
+        return " ".join(stripped for stripped in (part.strip() for part in element.itertext()) if stripped)
+    
+    parts = []
+    stack = [element]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            parts.append(item)
+            continue
+        # Comments and processing instructions have a non-string tag
+        if not isinstance(item.tag, str) or item.tag in _SKIP_TEXT_TAGS:
+            continue
+        if item.text:
+            parts.append(item.text)
+        # Children (and their tails) pushed in reverse so they pop in document order
+        for child in reversed(item):
+            if child.tail:
+                stack.append(child.tail)
+            stack.append(child)
+    return " ".join(stripped for stripped in (part.strip() for part in parts) if stripped)
+
+
+def _truncate(text: str, limit: int) -> str:
+    """Return text unchanged when it fits, else its first `limit` chars plus an ellipsis"""
+    return text if len(text) <= limit else text[:limit] + "..."
+
+# Odyssey-specific patterns, one compiled alternation per category
+_BOOK_RE = re.compile(
+    r'^(?:'
+    r'BOOK\s+[IVXLCDM]+'  # BOOK I, BOOK II, etc.
+    r'|Book\s+[IVXLCDM]+'
+    r'|BOOK\s+\d+'
+    r'|CHAPTER\s+[IVXLCDM]+'
+    r'|Chapter\s+[IVXLCDM]+'
+    r')'
+)
+
+# Section patterns for HTML structure; tried in order, the matching group gives the level
+_SECTION_RE = re.compile(
+    r'^(?:'
+    r'(?P<roman>[IVXLCDM]+\.)'  # Roman numerals followed by dot
+    r'|(?P<number>\d+\.)'  # Numbers followed by dot
+    r'|(?P<letter>[A-Z]\.)'  # Capital letters followed by dot
+    r')'
+)
+_SECTION_LEVELS = {"roman": 2, "number": 2, "letter": 3}
+
+@dataclass(slots=True)
 class DocumentNode:
     """Node in document hierarchy for HTML content"""
     id: str
@@ -20,6 +79,7 @@ class DocumentNode:
     children_ids: List[str]
     metadata: Dict
     tag_name: str
+    word_count: int = 0
 
 
 class HTMLHierarchicalProcessor:
@@ -32,48 +92,50 @@ class HTMLHierarchicalProcessor:
         self.nodes: Dict[str, DocumentNode] = {}
         self.root_nodes: List[str] = []
         
-        # Odyssey-specific patterns
-        self.book_patterns = [
-            (r'^BOOK\s+([IVXLCDM]+)', 1),  # BOOK I, BOOK II, etc.
-            (r'^Book\s+([IVXLCDM]+)', 1),
-            (r'^BOOK\s+(\d+)', 1),
-            (r'^CHAPTER\s+([IVXLCDM]+)', 1),
-            (r'^Chapter\s+([IVXLCDM]+)', 1),
-        ]
+        # Column arrays aligned with self.nodes order, rebuilt after process_html
+        self._node_ids: List[str] = []
+        self._levels = np.empty(0, dtype=np.int8)
+        self._word_counts = np.empty(0, dtype=np.int32)
+        self._is_root = np.empty(0, dtype=bool)
         
-        # Section patterns for HTML structure
-        self.section_patterns = [
-            (r'^[IVXLCDM]+\.', 2),  # Roman numerals followed by dot
-            (r'^\d+\.', 2),         # Numbers followed by dot
-            (r'^[A-Z]\.', 3),       # Capital letters followed by dot
-        ]
-    
     def _identify_book_chapter(self, text: str) -> Tuple[Optional[str], int]:
         """Identify if text is a book/chapter header"""
-        for pattern, level in self.book_patterns:
-            match = re.match(pattern, text.strip())
-            if match:
-                return match.group(0), level
+        match = _BOOK_RE.match(text.strip())
+        if match:
+            return match.group(0), 1  # All book/chapter forms are level 1
         return None, 0
     
     def _identify_section(self, text: str) -> Tuple[Optional[str], int]:
         """Identify if text is a section header"""
-        for pattern, level in self.section_patterns:
-            match = re.match(pattern, text.strip())
-            if match:
-                return match.group(0), level
+        match = _SECTION_RE.match(text.strip())
+        if match:
+            return match.group(0), _SECTION_LEVELS[match.lastgroup]
         return None, 0
     
+    def _iter_content_elements(self) -> Iterator[Tuple[str, str]]:
+        """
+        Stream the HTML through lxml and yield (tag, text) for each content element
+        in document order, freeing each subtree once it has been yielded
+        """
+        context = etree.iterparse(
+            self.html_path, events=("end",), tag=_CONTENT_TAGS, html=True, encoding="utf-8"
+        )
+        for _, element in context:
+            # Nested content elements are yielded with their outermost content ancestor,
+            # which is complete at its own end event
+            if next(element.iterancestors(*_CONTENT_TAGS), None) is not None:
+                continue
+            
+            for sub in element.iter(*_CONTENT_TAGS):
+                # lxml builds a fresh str per .tag access; intern so every node shares one
+                yield intern(sub.tag), _element_text(sub)
+            
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+    
     def process_html(self) -> List[DocumentNode]:
         """Process Odyssey HTML with semantic structure"""
-        with open(self.html_path, "r", encoding="utf-8") as f:
-            soup = BeautifulSoup(f, "html.parser")
-        
-        # Remove unwanted tags
-        for tag in soup(["style", "script", "meta", "link", "head"]):
-            tag.decompose()
-        
-        content = soup.body or soup
         nodes = []
         node_id = 0
         
@@ -85,17 +147,15 @@ class HTMLHierarchicalProcessor:
         }
         
         # Process all text elements
-        for element in content.find_all(["h1", "h2", "h3", "h4", "h5", "h6", "p", "div"]):
-            if element.name in ["script", "style"]:
-                continue
-            
-            text = element.get_text(" ", strip=True)
+        for tag_name, text in self._iter_content_elements():
             if not text:
                 continue
+            word_count = len(text.split())  # Counted once, reused below
             
             # Check if this is a book/chapter header
             book_match, book_level = self._identify_book_chapter(text)
             if book_match:
+                book_match = intern(book_match)  # Repeated ids share one string
                 # Create book node
                 book_node = DocumentNode(
                     id=f"book_{node_id}",
@@ -106,9 +166,10 @@ class HTMLHierarchicalProcessor:
                     metadata={
                         "type": "book",
                         "book_id": book_match,
-                        "tag": element.name
+                        "tag": tag_name
                     },
-                    tag_name=element.name
+                    tag_name=tag_name,
+                    word_count=word_count
                 )
                 nodes.append(book_node)
                 self.nodes[book_node.id] = book_node
@@ -124,7 +185,8 @@ class HTMLHierarchicalProcessor:
             
             # Check if this is a section header
             section_match, section_level = self._identify_section(text)
-            if section_match and len(text.split()) < 20:  # Likely a header, not paragraph
+            if section_match and word_count < 20:  # Likely a header, not paragraph
+                section_match = intern(section_match)
                 section_node = DocumentNode(
                     id=f"section_{node_id}",
                     text=text,
@@ -134,9 +196,10 @@ class HTMLHierarchicalProcessor:
                     metadata={
                         "type": "section",
                         "section_id": section_match,
-                        "tag": element.name
+                        "tag": tag_name
                     },
-                    tag_name=element.name
+                    tag_name=tag_name,
+                    word_count=word_count
                 )
                 nodes.append(section_node)
                 self.nodes[section_node.id] = section_node
@@ -154,7 +217,7 @@ class HTMLHierarchicalProcessor:
             
             # Regular paragraph or content
             # Check if it's substantial content (not just a few words)
-            if len(text.split()) > 10:
+            if word_count > 10:
                 # Determine parent: subsection > section > book
                 parent_id = None
                 if current_hierarchy["subsection"]:
@@ -162,7 +225,7 @@ class HTMLHierarchicalProcessor:
                 elif current_hierarchy["section"]:
                     parent_id = current_hierarchy["section"]
                     # Check if we should create a subsection
-                    if len(text.split()) < 50 and ":" in text:  # Likely a subsection header
+                    if word_count < 50 and ":" in text:  # Likely a subsection header
                         # Create subsection
                         subsection_node = DocumentNode(
                             id=f"subsection_{node_id}",
@@ -172,9 +235,10 @@ class HTMLHierarchicalProcessor:
                             children_ids=[],
                             metadata={
                                 "type": "subsection",
-                                "tag": element.name
+                                "tag": tag_name
                             },
-                            tag_name=element.name
+                            tag_name=tag_name,
+                            word_count=word_count
                         )
                         nodes.append(subsection_node)
                         self.nodes[subsection_node.id] = subsection_node
@@ -201,10 +265,11 @@ class HTMLHierarchicalProcessor:
                     children_ids=[],
                     metadata={
                         "type": "paragraph",
-                        "word_count": len(text.split()),
-                        "tag": element.name
+                        "word_count": word_count,
+                        "tag": tag_name
                     },
-                    tag_name=element.name
+                    tag_name=tag_name,
+                    word_count=word_count
                 )
                 nodes.append(para_node)
                 self.nodes[para_node.id] = para_node
@@ -218,52 +283,45 @@ class HTMLHierarchicalProcessor:
         print(f"Created {len(nodes)} hierarchical nodes")
         print(f"Root nodes (books/chapters): {len(self.root_nodes)}")
         
+        self._build_node_arrays()
         return nodes
     
+    def _build_node_arrays(self):
+        """Level and word-count columns so node filters are vectorized scans"""
+        count = len(self.nodes)
+        self._node_ids = list(self.nodes.keys())
+        self._levels = np.fromiter((n.level for n in self.nodes.values()), dtype=np.int8, count=count)
+        self._word_counts = np.fromiter((n.word_count for n in self.nodes.values()), dtype=np.int32, count=count)
+        root_ids = set(self.root_nodes)
+        self._is_root = np.fromiter((node_id in root_ids for node_id in self._node_ids), dtype=bool, count=count)
+    
     def create_semantic_chunks(self, min_words: int = 50, max_words: int = 300) -> List[Dict]:
         """Create chunks based on semantic structure"""
-        chunks = []
+        unique_chunks: Dict[str, Dict] = {}
         
-        # Strategy 1: Use book-level chunks for overview
-        for root_id in self.root_nodes:
-            root_node = self.nodes[root_id]
-            chunk_text = self._collect_subtree_text(root_id, max_depth=2, max_words=max_words)
-            
-            if chunk_text and len(chunk_text.split()) >= min_words:
-                chunks.append({
-                    "chunk_id": root_id,
-                    "text": chunk_text,
-                    "metadata": {
-                        **root_node.metadata,
-                        "chunk_type": "book_overview",
-                        "level": root_node.level,
-                        "parent_id": root_node.parent_id,
-                        "children_count": len(root_node.children_ids)
-                    }
-                })
+        if len(self._node_ids) != len(self.nodes):
+            self._build_node_arrays()
         
-        # Strategy 2: Use section-level chunks for detailed content
-        for node_id, node in self.nodes.items():
-            if node.level == 2:  # Section level
-                chunk_text = self._collect_subtree_text(node_id, max_depth=3, max_words=max_words)
-                
-                if chunk_text and len(chunk_text.split()) >= min_words:
-                    chunks.append({
-                        "chunk_id": node_id,
-                        "text": chunk_text,
-                        "metadata": {
-                            **node.metadata,
-                            "chunk_type": "section_detail",
-                            "level": node.level,
-                            "parent_id": node.parent_id,
-                            "children_count": len(node.children_ids)
-                        }
-                    })
+        # Only roots, sections and substantial paragraphs can produce chunks
+        eligible = self._is_root | (self._levels == 2) | ((self._levels == 4) & (self._word_counts >= 30))
         
-        # Strategy 3: Individual paragraphs for very specific content
-        for node_id, node in self.nodes.items():
-            if node.level == 4 and len(node.text.split()) >= 30:  # Substantial paragraphs
-                chunks.append({
+        # One pass over the eligible nodes; each node keeps its most comprehensive chunk
+        for idx in np.flatnonzero(eligible):
+            node_id = self._node_ids[idx]
+            node = self.nodes[node_id]
+            candidates = []
+            
+            # Strategy 1: Use book-level chunks for overview
+            if self._is_root[idx]:
+                candidates.append(self._subtree_chunk(node_id, "book_overview", 2, min_words, max_words))
+            
+            # Strategy 2: Use section-level chunks for detailed content
+            if node.level == 2:
+                candidates.append(self._subtree_chunk(node_id, "section_detail", 3, min_words, max_words))
+            
+            # Strategy 3: Individual paragraphs for very specific content
+            elif node.level == 4 and node.word_count >= 30:  # Substantial paragraphs
+                candidates.append({
                     "chunk_id": node_id,
                     "text": node.text,
                     "metadata": {
@@ -274,63 +332,111 @@ class HTMLHierarchicalProcessor:
                         "children_count": 0
                     }
                 })
+            
+            for chunk in candidates:
+                if chunk is None:
+                    continue
+                existing = unique_chunks.get(node_id)
+                if existing is None or len(chunk["text"]) > len(existing["text"]):
+                    unique_chunks[node_id] = chunk
         
-        # Remove duplicates and sort by hierarchy level
-        unique_chunks = {}
-        for chunk in chunks:
-            if chunk["chunk_id"] not in unique_chunks:
-                unique_chunks[chunk["chunk_id"]] = chunk
-            else:
-                # Keep the more comprehensive chunk
-                if len(chunk["text"]) > len(unique_chunks[chunk["chunk_id"]]["text"]):
-                    unique_chunks[chunk["chunk_id"]] = chunk
-        
-        final_chunks = list(unique_chunks.values())
-        final_chunks.sort(key=lambda x: x["metadata"]["level"])
+        # Sort by hierarchy level (stable, so node order is kept within a level)
+        final_chunks = sorted(unique_chunks.values(), key=lambda x: x["metadata"]["level"])
         
         print(f"Created {len(final_chunks)} semantic chunks")
         return final_chunks
     
+    def _subtree_chunk(
+        self, node_id: str, chunk_type: str, max_depth: int, min_words: int, max_words: int
+    ) -> Optional[Dict]:
+        """Chunk of a node plus its subtree text, or None if it is below min_words"""
+        node = self.nodes[node_id]
+        chunk_text, chunk_words = self._collect_subtree_text_counted(node_id, max_depth=max_depth, max_words=max_words)
+        
+        if not chunk_text or chunk_words < min_words:
+            return None
+        
+        return {
+            "chunk_id": node_id,
+            "text": chunk_text,
+            "metadata": {
+                **node.metadata,
+                "chunk_type": chunk_type,
+                "level": node.level,
+                "parent_id": node.parent_id,
+                "children_count": len(node.children_ids)
+            }
+        }
+    
     def _collect_subtree_text(self, node_id: str, max_depth: int = 2, max_words: int = 300) -> str:
         """Collect text from node and its children up to max_depth"""
-        if node_id not in self.nodes:
-            return ""
-        
-        node = self.nodes[node_id]
-        texts = [node.text]
-        current_words = len(node.text.split())
+        return self._collect_subtree_text_counted(node_id, max_depth, max_words)[0]
+    
+    def _collect_subtree_text_counted(self, node_id: str, max_depth: int, max_words: int) -> Tuple[str, int]:
+        """Like _collect_subtree_text, but also returns the word count so callers never re-split"""
+        texts = []
+        used = 0
+        stack = [(node_id, max_depth)]
         
-        if max_depth > 0 and node.children_ids:
-            for child_id in node.children_ids[:10]:  # Limit children
-                if current_words >= max_words:
-                    break
-                
-                child_text = self._collect_subtree_text(child_id, max_depth - 1, max_words - current_words)
-                if child_text:
-                    texts.append(child_text)
-                    current_words += len(child_text.split())
+        # Preorder walk; once the word budget is spent no further node is added
+        while stack:
+            if texts and used >= max_words:
+                break
+            
+            current_id, depth = stack.pop()
+            node = self.nodes.get(current_id)
+            if node is None or not node.text:
+                continue
+            
+            texts.append(node.text)
+            used += node.word_count
+            
+            if depth > 0 and node.children_ids:
+                # Limit children; push in reverse so the first child is visited first
+                stack.extend((child_id, depth - 1) for child_id in reversed(node.children_ids[:10]))
         
-        return "\n\n".join(texts)
+        return "\n\n".join(texts), used
     
     def save_hierarchy(self, output_path: str):
         """Save hierarchy to JSON file"""
-        hierarchy_data = {
-            "nodes": {k: self._node_to_dict(v) for k, v in self.nodes.items()},
-            "root_nodes": self.root_nodes
+        Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+        
+        with open(output_path, "wb") as f:
+            self._write_hierarchy(f)
+        
+        print(f"Saved hierarchy to {output_path}")
+    
+    def save_hierarchy_with_stats(self, output_path: str):
+        """Save hierarchy plus node stats, ready to be served as a static file"""
+        level_counts = Counter(node.level for node in self.nodes.values())
+        stats = {
+            "total_nodes": len(self.nodes),
+            "level_counts": dict(sorted(level_counts.items()))
         }
         
         Path(output_path).parent.mkdir(parents=True, exist_ok=True)
         
-        with open(output_path, "w", encoding="utf-8") as f:
-            json.dump(hierarchy_data, f, indent=2, ensure_ascii=False)
+        with open(output_path, "wb") as f:
+            f.write(b'{"hierarchy":')
+            self._write_hierarchy(f)
+            f.write(b',"stats":' + orjson.dumps(stats, option=orjson.OPT_NON_STR_KEYS) + b'}')
         
-        print(f"Saved hierarchy to {output_path}")
+        print(f"Saved hierarchy with stats to {output_path}")
+    
+    def _write_hierarchy(self, f: BinaryIO):
+        """Stream {"nodes": {...}, "root_nodes": [...]} node by node, never building the full dict"""
+        f.write(b'{"nodes":{')
+        for i, (node_id, node) in enumerate(self.nodes.items()):
+            if i:
+                f.write(b',')
+            f.write(orjson.dumps(node_id) + b':' + orjson.dumps(self._node_to_dict(node)))
+        f.write(b'},"root_nodes":' + orjson.dumps(self.root_nodes) + b'}')
     
     def _node_to_dict(self, node: DocumentNode) -> Dict:
         """Convert DocumentNode to serializable dict"""
         return {
             "id": node.id,
-            "text_preview": node.text[:100] + "..." if len(node.text) > 100 else node.text,
+            "text_preview": _truncate(node.text, 100),
             "text_length": len(node.text),
             "level": node.level,
             "parent_id": node.parent_id,
@@ -1,5 +1,7 @@
+import asyncio
 import os
-from typing import Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Dict, Iterator, List, Optional
 
 from dotenv import load_dotenv
 from google.generativeai.client import configure
@@ -50,6 +52,136 @@ class GeminiGenerator:
         except Exception as e:
             return f"Generation error: {e}"
 
+    async def agenerate(
+        self,
+        prompt: str,
+        max_new_tokens: int = 256,
+        temperature: float = 0.2,
+    ) -> str:
+        """
+        Async variant of generate() so callers on an event loop are not blocked.
+        """
+        try:
+            response = await self.model.generate_content_async(
+                prompt,
+                generation_config={
+                    "max_output_tokens": max_new_tokens,
+                    "temperature": temperature,
+                },
+            )
+
+            text = getattr(response, "text", None)
+            if not text:
+                return "I couldn’t generate a meaningful answer from the available information."
+
+            return text.strip()
+
+        except Exception as e:
+            return f"Generation error: {e}"
+
+    def generate_batch(
+        self,
+        prompts: List[str],
+        max_new_tokens: int = 256,
+        temperature: float = 0.2,
+        max_concurrency: int = 8,
+    ) -> List[str]:
+        """
+        Generate answers for many prompts with concurrent requests, in prompt order.
+        Uses a thread pool over generate(), so it is safe to call while an event
+        loop is running; async callers can await agenerate_batch() instead.
+        """
+        if not prompts:
+            return []
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(prompts)))) as pool:
+            return list(
+                pool.map(lambda prompt: self.generate(prompt, max_new_tokens, temperature), prompts)
+            )
+
+    async def agenerate_batch(
+        self,
+        prompts: List[str],
+        max_new_tokens: int = 256,
+        temperature: float = 0.2,
+        max_concurrency: int = 8,
+    ) -> List[str]:
+        """
+        Fire agenerate() for every prompt, at most max_concurrency in flight.
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def run(prompt: str) -> str:
+            async with semaphore:
+                return await self.agenerate(prompt, max_new_tokens, temperature)
+
+        return list(await asyncio.gather(*(run(prompt) for prompt in prompts)))
+
+    def stream(
+        self,
+        prompt: str,
+        max_new_tokens: int = 256,
+        temperature: float = 0.2,
+    ) -> Iterator[str]:
+        """
+        Stream text from Gemini chunk by chunk as it is generated.
+        Same generation settings as generate().
+        """
+        try:
+            response = self.model.generate_content(
+                prompt,
+                generation_config={
+                    "max_output_tokens": max_new_tokens,
+                    "temperature": temperature,
+                },
+                stream=True,
+            )
+
+            produced = False
+            for chunk in response:
+                text = getattr(chunk, "text", None)
+                if text:
+                    produced = True
+                    yield text
+
+            if not produced:
+                yield "I couldn’t generate a meaningful answer from the available information."
+
+        except Exception as e:
+            yield f"Generation error: {e}"
+
+    async def astream(
+        self,
+        prompt: str,
+        max_new_tokens: int = 256,
+        temperature: float = 0.2,
+    ) -> AsyncIterator[str]:
+        """
+        Async variant of stream() using the async Gemini client.
+        """
+        try:
+            response = await self.model.generate_content_async(
+                prompt,
+                generation_config={
+                    "max_output_tokens": max_new_tokens,
+                    "temperature": temperature,
+                },
+                stream=True,
+            )
+
+            produced = False
+            async for chunk in response:
+                text = getattr(chunk, "text", None)
+                if text:
+                    produced = True
+                    yield text
+
+            if not produced:
+                yield "I couldn’t generate a meaningful answer from the available information."
+
+        except Exception as e:
+            yield f"Generation error: {e}"
+
 
     def format_context(self, retrieved_chunks: List[Dict]) -> str:
         """
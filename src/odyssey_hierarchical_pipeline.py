@@ -1,13 +1,90 @@
 # src/odyssey_hierarchical_pipeline.py (UPDATED)
-from typing import Dict, List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple
+from collections import OrderedDict
+from functools import lru_cache
+import asyncio
 import logging
-from .html_hierarchical_processor import HTMLHierarchicalProcessor
+import re
+import sys
+import numpy as np
+from sentence_transformers import SentenceTransformer
+from .html_hierarchical_processor import HTMLHierarchicalProcessor, _truncate
 from .simple_hierarchical_retriever import SimpleHierarchicalRetriever, HierarchicalResult
+from .batched_retriever import BatchedRetriever
 from .llm_generator import GeminiGenerator
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+ANSWER_CACHE_SIZE = 256
+_WHITESPACE_RE = re.compile(r"\s+")
+
+# Context formatting pieces; chunk levels only run 1-4
+_INDENTS = {1: "", 2: "  ", 3: "    ", 4: "      "}
+_CONTEXT_SEPARATOR = "-" * 40
+
+
+@lru_cache(maxsize=64)
+def _level_label(level: int, chunk_type: str) -> str:
+    """Hierarchy label shown above each context chunk"""
+    return f"[Level {level}: {chunk_type}]"
+
+
+def _keyword_pattern(keywords) -> re.Pattern:
+    """Substring alternation over keywords (same matching as `keyword in text`)"""
+    return re.compile("|".join(re.escape(k) for k in sorted(keywords)))
+
+
+_QUESTION_TYPE_PATTERNS = (
+    # Odyssey character questions
+    ("character", _keyword_pattern({
+        "odysseus", "penelope", "telemachus", "athena", "poseidon",
+        "circe", "calypso", "polyphemus", "nestor", "menelaus",
+        "agamemnon", "nausicaa", "eumaeus", "antinous", "eurymachus"
+    })),
+    # Overview questions
+    ("overview", _keyword_pattern({
+        "what is", "who is", "describe", "explain", "tell me about",
+        "overview", "summary", "introduction", "background"
+    })),
+    # Detail questions
+    ("detail", _keyword_pattern({
+        "how did", "when did", "where did", "why did", "what happened",
+        "specific", "exact", "detailed", "specifically"
+    })),
+    # Book/chapter questions
+    ("structural", _keyword_pattern({
+        "book", "chapter", "part", "canto", "section"
+    })),
+)
+
+# Answer instructions per question type
+_INSTRUCTIONS = {
+    "overview": "Provide a comprehensive overview. Focus on main themes and key points.",
+    "detail": "Provide specific, detailed information. Include exact events and descriptions.",
+    "character": "Focus on character traits, actions, and significance in the story.",
+    "structural": "Focus on the structure, organization, and key sections.",
+}
+_DEFAULT_INSTRUCTIONS = "Provide a clear, accurate answer based on the context."
+
+_PROMPT_TEMPLATE = """You are an expert on Homer's Odyssey. Answer the question based on the provided context.
+
+Context (organized by document structure - indentation shows hierarchy):
+{context}
+
+Question: {question}
+
+{instructions}
+
+Guidelines:
+1. Base your answer primarily on the context provided.
+2. If the context doesn't fully answer, you may supplement with general knowledge.
+3. Be specific about characters, events, and locations when possible.
+4. Do not invent or hallucinate details not present in the context.
+5. If unsure, acknowledge the limitations of the available information.
+
+Answer in clear, concise English:"""
+
 
 class OdysseyHierarchicalPipeline:
     """
@@ -17,12 +94,18 @@ class OdysseyHierarchicalPipeline:
     def __init__(
         self,
         html_path: str = "data/raw/odyssey.html",
-        model_name: str = "gemini-2.5-flash-lite"
+        model_name: str = "gemini-2.5-flash-lite",
+        embedder: Optional[SentenceTransformer] = None,
+        generator: Optional[GeminiGenerator] = None,
+        encoder_backend: str = "torch"  # torch, onnx-int8 (ignored when embedder is given)
     ):
+        # embedder/generator can be injected so they outlive a pipeline rebuild
         self.html_path = html_path
         self.processor = HTMLHierarchicalProcessor(html_path)
-        self.retriever = SimpleHierarchicalRetriever()
-        self.generator = GeminiGenerator(model_name)
+        self.retriever = SimpleHierarchicalRetriever(model=embedder, encoder_backend=encoder_backend)
+        self.batched_retriever = BatchedRetriever(self.retriever)
+        self.generator = generator if generator is not None else GeminiGenerator(model_name)
+        self._answer_cache: "OrderedDict[tuple, Dict]" = OrderedDict()
         
         # Process the HTML once
         self.nodes = self.processor.process_html()
@@ -31,8 +114,9 @@ class OdysseyHierarchicalPipeline:
         # Create embeddings
         self.retriever.create_embeddings(self.chunks)
         
-        # Save hierarchy for reference
+        # Save hierarchy for reference, plus a stats-embedded copy for the API
         self.processor.save_hierarchy("data/processed/hierarchy.json")
+        self.processor.save_hierarchy_with_stats("data/processed/hierarchy_with_stats.json")
         
         logger.info(f"Pipeline initialized with {len(self.chunks)} semantic chunks")
     
@@ -41,33 +125,234 @@ class OdysseyHierarchicalPipeline:
         question: str,
         k: int = 5,
         threshold: float = 0.25,
-        strategy: str = "adaptive"  # adaptive, overview, detail, character, structural
+        strategy: str = "adaptive",  # adaptive, overview, detail, character, structural
+        history: Optional[List[str]] = None
     ) -> Dict:
         """
         Answer question with adaptive hierarchical retrieval
         """
-        # Analyze question type
-        question_type = self._analyze_question(question)
+        key = self._answer_cache_key(question, k, threshold, strategy, history)
+        cached = self._get_cached_answer(key)
+        if cached is not None:
+            return cached
+        
+        result = self.prepare_answer(question, k, threshold, strategy, history)
+        prompt = result.pop("prompt")
+        
+        if prompt is not None:
+            # Generate answer
+            answer = self.generator.generate(prompt, max_new_tokens=512)
+            result["answer"] = answer.strip()
+        
+        self._cache_answer(key, result)
+        return result
+    
+    async def answer_question_async(
+        self,
+        question: str,
+        k: int = 5,
+        threshold: float = 0.25,
+        strategy: str = "adaptive",
+        history: Optional[List[str]] = None
+    ) -> Dict:
+        """
+        Async answer_question(): retrieval is batched with concurrent callers
+        and generation uses the async Gemini client, so the event loop stays free
+        """
+        key = self._answer_cache_key(question, k, threshold, strategy, history)
+        cached = self._get_cached_answer(key)
+        if cached is not None:
+            return cached
+        
+        result = await self.prepare_answer_async(question, k, threshold, strategy, history)
+        prompt = result.pop("prompt")
+        
+        if prompt is not None:
+            answer = await self.generator.agenerate(prompt, max_new_tokens=512)
+            result["answer"] = answer.strip()
+        
+        self._cache_answer(key, result)
+        return result
+    
+    @staticmethod
+    def _answer_cache_key(
+        question: str,
+        k: int,
+        threshold: float,
+        strategy: str,
+        history: Optional[List[str]]
+    ) -> tuple:
+        """Normalize case and whitespace so trivially different questions share an entry"""
+        normalized = _WHITESPACE_RE.sub(" ", question.strip().lower())
+        return (normalized, k, round(threshold, 3), strategy, tuple(history or ()))
+    
+    def _get_cached_answer(self, key: tuple) -> Optional[Dict]:
+        cached = self._answer_cache.get(key)
+        if cached is None:
+            return None
+        self._answer_cache.move_to_end(key)
+        return dict(cached)  # Shallow copy so callers can't mutate the cached entry
+    
+    def _cache_answer(self, key: tuple, result: Dict) -> None:
+        # Transient API failures should be retried, not replayed
+        if result.get("answer", "").startswith("Generation error:"):
+            return
+        self._answer_cache[key] = dict(result)
+        if len(self._answer_cache) > ANSWER_CACHE_SIZE:
+            self._answer_cache.popitem(last=False)
+    
+    def answer_questions(
+        self,
+        questions: List[str],
+        k: int = 5,
+        threshold: float = 0.25,
+        strategy: str = "adaptive",
+        max_concurrency: int = 8
+    ) -> List[Dict]:
+        """
+        answer_question() for many questions: cached answers are reused, repeated
+        questions are answered once, the rest get one batched retrieval, then
+        concurrent Gemini requests (at most max_concurrency in flight)
+        """
+        keys = [self._answer_cache_key(question, k, threshold, strategy, None) for question in questions]
+        results: List[Optional[Dict]] = [self._get_cached_answer(key) for key in keys]
+        # Repeats of the same normalized question share one retrieval and generation
+        first_miss: Dict[tuple, int] = {}
+        for i, result in enumerate(results):
+            if result is None:
+                first_miss.setdefault(keys[i], i)
+        if not first_miss:
+            return results
+        
+        misses = list(first_miss.values())
+        miss_questions = [questions[i] for i in misses]
+        plans = [self._plan_retrieval(question, k, threshold, strategy) for question in miss_questions]
+        batch_results = self.retriever.retrieve_with_context_batch(
+            miss_questions, [retrieval_kwargs for _, retrieval_kwargs in plans]
+        )
+        
+        miss_results = [
+            self._build_result(question, question_type, strategy, retrieval_kwargs, retrieved_results)
+            for question, (question_type, retrieval_kwargs), retrieved_results
+            in zip(miss_questions, plans, batch_results)
+        ]
+        
+        # Only questions with retrieved context need a generation request
+        pending = [(result, result.pop("prompt")) for result in miss_results]
+        pending = [(result, prompt) for result, prompt in pending if prompt is not None]
+        answers = self.generator.generate_batch(
+            [prompt for _, prompt in pending], max_new_tokens=512, max_concurrency=max_concurrency
+        )
+        for (result, _), answer in zip(pending, answers):
+            result["answer"] = answer.strip()
+        
+        for i, result in zip(misses, miss_results):
+            self._cache_answer(keys[i], result)
+            results[i] = result
+        
+        for i, key in enumerate(keys):
+            if results[i] is None:
+                results[i] = dict(results[first_miss[key]])
+        
+        return results
+    
+    def prepare_answer(
+        self,
+        question: str,
+        k: int = 5,
+        threshold: float = 0.25,
+        strategy: str = "adaptive",
+        history: Optional[List[str]] = None
+    ) -> Dict:
+        """
+        Run retrieval and build the LLM prompt without generating.
+        
+        The returned dict has the same keys as answer_question() plus "prompt";
+        "prompt" is None (and "answer" is set) when nothing was retrieved.
+        Callers stream or generate the answer from "prompt" themselves.
+        history holds earlier user questions used as extra retrieval context.
+        """
+        question_type, retrieval_kwargs = self._plan_retrieval(question, k, threshold, strategy)
+        
+        # Perform hierarchical retrieval
+        if history:
+            retrieved_results = self.retriever.retrieve_with_history(
+                query=question,
+                history=history,
+                **retrieval_kwargs
+            )
+        else:
+            retrieved_results = self.retriever.retrieve_with_context(
+                query=question,
+                **retrieval_kwargs
+            )
+        
+        return self._build_result(question, question_type, strategy, retrieval_kwargs, retrieved_results)
+    
+    async def prepare_answer_async(
+        self,
+        question: str,
+        k: int = 5,
+        threshold: float = 0.25,
+        strategy: str = "adaptive",
+        history: Optional[List[str]] = None
+    ) -> Dict:
+        """
+        Async prepare_answer(); concurrent questions share one batched
+        query encode and FAISS search through the BatchedRetriever
+        """
+        question_type, retrieval_kwargs = self._plan_retrieval(question, k, threshold, strategy)
+        
+        if history:
+            # Already one batched search over question + history
+            retrieved_results = await asyncio.to_thread(
+                self.retriever.retrieve_with_history, question, history, **retrieval_kwargs
+            )
+        else:
+            retrieved_results = await self.batched_retriever.submit(question, **retrieval_kwargs)
+        
+        return self._build_result(question, question_type, strategy, retrieval_kwargs, retrieved_results)
+    
+    def _plan_retrieval(
+        self,
+        question: str,
+        k: int,
+        threshold: float,
+        strategy: str
+    ) -> Tuple[str, Dict]:
+        """Resolve question type and retrieval kwargs for a question"""
+        # Analyze question type (an explicit strategy is used as the type)
+        if strategy == "adaptive":
+            question_type = self._analyze_question(question)
+        else:
+            question_type = strategy
         logger.info(f"Question type: {question_type}")
         
         # Get retrieval parameters based on question type
         retrieval_kwargs = self._get_retrieval_kwargs(question_type, k, threshold)
         
-        # Perform hierarchical retrieval
-        retrieved_results = self.retriever.retrieve_with_context(
-            query=question,
-            **retrieval_kwargs
-        )
-        
+        return question_type, retrieval_kwargs
+    
+    def _build_result(
+        self,
+        question: str,
+        question_type: str,
+        strategy: str,
+        retrieval_kwargs: Dict,
+        retrieved_results: List[HierarchicalResult]
+    ) -> Dict:
+        """Build the prompt and source list from retrieved results"""
         logger.info(f"Retrieved {len(retrieved_results)} results")
         
         if not retrieved_results:
             return {
                 "answer": "I couldn't find relevant information about that in The Odyssey.",
+                "prompt": None,
                 "sources": [],
                 "question_type": question_type,
                 "strategy": strategy,
-                "retrieval_params": retrieval_kwargs
+                "retrieval_params": retrieval_kwargs,
+                "chunks_retrieved": 0
             }
         
         # Format context with hierarchy information
@@ -76,26 +361,29 @@ class OdysseyHierarchicalPipeline:
         # Create prompt
         prompt = self._create_odyssey_prompt(context, question, question_type)
         
-        # Generate answer
-        answer = self.generator.generate(prompt, max_new_tokens=512)
-        
-        # Prepare sources for display
-        sources = []
-        for result in retrieved_results:
-            source_info = {
+        # Prepare sources for display (single pass; mean computed in NumPy)
+        similarities = np.fromiter(
+            (result.similarity for result in retrieved_results),
+            dtype=np.float32,
+            count=len(retrieved_results)
+        )
+        sources = [
+            {
                 "chunk_id": result.chunk_id,
-                "similarity": round(result.similarity, 3),
+                "similarity": round(float(similarity), 3),
                 "chunk_type": result.metadata.get("chunk_type", "unknown"),
                 "level": result.metadata.get("level", "unknown"),
                 "has_parent": result.parent_text is not None,
                 "child_count": result.child_count,
-                "text_preview": result.text[:150] + "..." if len(result.text) > 150 else result.text
+                "text_preview": _truncate(result.text, 150)
             }
-            sources.append(source_info)
+            for result, similarity in zip(retrieved_results, similarities)
+        ]
         
         return {
-            "answer": answer.strip(),
+            "prompt": prompt,
             "sources": sources,
+            "avg_similarity": float(similarities.mean()),
             "question_type": question_type,
             "strategy": strategy,
             "retrieval_params": retrieval_kwargs,
@@ -104,56 +392,30 @@ class OdysseyHierarchicalPipeline:
     
     def _analyze_question(self, question: str) -> str:
         """Analyze question to determine retrieval strategy"""
+        return self._analyze_question_cached(question)
+    
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def _analyze_question_cached(question: str) -> str:
+        """Memoized classifier; pure in question"""
         question_lower = question.lower()
         
-        # Odyssey character questions
-        odyssey_characters = {
-            "odysseus", "penelope", "telemachus", "athena", "poseidon",
-            "circe", "calypso", "polyphemus", "nestor", "menelaus",
-            "agamemnon", "nausicaa", "eumaeus", "antinous", "eurymachus"
-        }
-        
-        # Overview questions
-        overview_indicators = {
-            "what is", "who is", "describe", "explain", "tell me about",
-            "overview", "summary", "introduction", "background"
-        }
-        
-        # Detail questions
-        detail_indicators = {
-            "how did", "when did", "where did", "why did", "what happened",
-            "specific", "exact", "detailed", "specifically"
-        }
-        
-        # Book/chapter questions
-        book_indicators = {
-            "book", "chapter", "part", "canto", "section"
-        }
-        
-        # Check for character questions
-        for character in odyssey_characters:
-            if character in question_lower:
-                return "character"
-        
-        # Check for overview questions
-        for indicator in overview_indicators:
-            if indicator in question_lower:
-                return "overview"
-        
-        # Check for detail questions
-        for indicator in detail_indicators:
-            if indicator in question_lower:
-                return "detail"
-        
-        # Check for book/chapter questions
-        for indicator in book_indicators:
-            if indicator in question_lower:
-                return "structural"
+        # Categories are checked in priority order; each is one regex scan of the question
+        for question_type, pattern in _QUESTION_TYPE_PATTERNS:
+            if pattern.search(question_lower):
+                return question_type
         
         return "general"
     
     def _get_retrieval_kwargs(self, question_type: str, k: int, threshold: float) -> Dict:
         """Get retrieval keyword arguments based on question type"""
+        # Fresh dict per call so callers can't mutate the cached entry
+        return dict(self._retrieval_kwargs_cached(question_type, k, threshold))
+    
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def _retrieval_kwargs_cached(question_type: str, k: int, threshold: float) -> Tuple[Tuple[str, Any], ...]:
+        """Memoized kwargs builder; pure in (question_type, k, threshold)"""
         # Default parameters
         kwargs = {
             "k": k,
@@ -191,7 +453,7 @@ class OdysseyHierarchicalPipeline:
                 "include_children": True  # Include sections
             })
         
-        return kwargs
+        return tuple(kwargs.items())
     
     def _format_context_with_hierarchy(self, results: List[HierarchicalResult], question_type: str) -> str:
         """Format retrieved results with hierarchy indicators"""
@@ -199,15 +461,19 @@ class OdysseyHierarchicalPipeline:
             return "No relevant context found."
         
         context_parts = []
+        include_parent = question_type not in ("structural", "overview")
+        last = len(results) - 1
         
         for i, result in enumerate(results):
             # Add hierarchy indicator
             level = result.metadata.get("level", 4)
-            indent = "  " * (level - 1) if level > 1 else ""
-            level_label = f"[Level {level}: {result.metadata.get('chunk_type', 'content')}]"
+            indent = _INDENTS.get(level)
+            if indent is None:
+                indent = "  " * (level - 1) if level > 1 else ""
+            level_label = _level_label(level, result.metadata.get("chunk_type", "content"))
             
             # Add parent context if available and relevant
-            if result.parent_text and question_type not in ["structural", "overview"]:
+            if include_parent and result.parent_text:
                 context_parts.append(f"{indent}Context from parent: {result.parent_text}")
             
             # Add main text
@@ -215,50 +481,21 @@ class OdysseyHierarchicalPipeline:
             if len(text_to_show) > 500:  # Truncate very long chunks
                 text_to_show = text_to_show[:500] + "... [truncated]"
             
-            context_parts.append(f"{indent}{level_label}")
-            context_parts.append(f"{indent}{text_to_show}")
+            context_parts.extend((indent + level_label, indent + text_to_show))
             
             # Add separator
-            if i < len(results) - 1:
-                context_parts.append("-" * 40)
+            if i < last:
+                context_parts.append(_CONTEXT_SEPARATOR)
         
         return "\n".join(context_parts)
     
     def _create_odyssey_prompt(self, context: str, question: str, question_type: str) -> str:
         """Create prompt tailored for Odyssey questions"""
-        
-        # Add instructions based on question type
-        instructions = ""
-        if question_type == "overview":
-            instructions = "Provide a comprehensive overview. Focus on main themes and key points."
-        elif question_type == "detail":
-            instructions = "Provide specific, detailed information. Include exact events and descriptions."
-        elif question_type == "character":
-            instructions = "Focus on character traits, actions, and significance in the story."
-        elif question_type == "structural":
-            instructions = "Focus on the structure, organization, and key sections."
-        else:
-            instructions = "Provide a clear, accurate answer based on the context."
-        
-        prompt = f"""You are an expert on Homer's Odyssey. Answer the question based on the provided context.
-
-Context (organized by document structure - indentation shows hierarchy):
-{context}
-
-Question: {question}
-
-{instructions}
-
-Guidelines:
-1. Base your answer primarily on the context provided.
-2. If the context doesn't fully answer, you may supplement with general knowledge.
-3. Be specific about characters, events, and locations when possible.
-4. Do not invent or hallucinate details not present in the context.
-5. If unsure, acknowledge the limitations of the available information.
-
-Answer in clear, concise English:"""
-
-        return prompt
+        return _PROMPT_TEMPLATE.format_map({
+            "context": context,
+            "question": question,
+            "instructions": _INSTRUCTIONS.get(question_type, _DEFAULT_INSTRUCTIONS)
+        })
     
     def save_system(self, base_path: str = "data/processed"):
         """Save the entire RAG system state"""
@@ -269,7 +506,7 @@ Answer in clear, concise English:"""
         self.retriever.save_index(
             index_path=f"{base_path}/faiss_index",
             chunks_path=f"{base_path}/semantic_chunks.json",
-            hierarchy_path=f"{base_path}/hierarchy_map.json"
+            hierarchy_path=f"{base_path}/hierarchy_map.npz"
         )
         
         print(f"System saved to {base_path}")
@@ -279,7 +516,7 @@ Answer in clear, concise English:"""
         self.retriever.load_index(
             index_path=f"{base_path}/faiss_index",
             chunks_path=f"{base_path}/semantic_chunks.json",
-            hierarchy_path=f"{base_path}/hierarchy_map.json"
+            hierarchy_path=f"{base_path}/hierarchy_map.npz"
         )
         
         print(f"System loaded from {base_path}")
@@ -291,17 +528,22 @@ Answer in clear, concise English:"""
         
         results = self.retriever.retrieve_with_context(query=question, **kwargs)
         
-        print(f"\nQuestion: {question}")
-        print(f"Type: {question_type}")
-        print(f"Retrieval params: {kwargs}")
-        print(f"Results: {len(results)}")
+        # Build the whole report first and write it once instead of a print per line
+        lines = [
+            f"\nQuestion: {question}",
+            f"Type: {question_type}",
+            f"Retrieval params: {kwargs}",
+            f"Results: {len(results)}",
+        ]
         
         for i, result in enumerate(results):
-            print(f"\n--- Result {i+1} ---")
-            print(f"Chunk ID: {result.chunk_id}")
-            print(f"Similarity: {result.similarity:.3f}")
-            print(f"Level: {result.metadata.get('level')}")
-            print(f"Type: {result.metadata.get('chunk_type')}")
+            lines.append(f"\n--- Result {i+1} ---")
+            lines.append(f"Chunk ID: {result.chunk_id}")
+            lines.append(f"Similarity: {result.similarity:.3f}")
+            lines.append(f"Level: {result.metadata.get('level')}")
+            lines.append(f"Type: {result.metadata.get('chunk_type')}")
             if result.parent_text:
-                print(f"Parent context: {result.parent_text}")
-            print(f"Text preview: {result.text[:200]}...")
\ No newline at end of file
+                lines.append(f"Parent context: {result.parent_text}")
+            lines.append(f"Text preview: {result.text[:200]}...")
+        
+        sys.stdout.write("\n".join(lines) + "\n")
\ No newline at end of file
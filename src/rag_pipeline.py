@@ -1,6 +1,14 @@
 # src/enhanced_rag_pipeline.py
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple, Union
+from dataclasses import asdict, dataclass
+from functools import lru_cache
+from pathlib import Path
+import asyncio
+import hashlib
 import logging
+import re
+import shutil
+import orjson
 from .hierarchical_retriever import HierarchicalRetriever, RetrievalResult
 from .data_processor import AdvancedDataProcessor
 from .llm_generator import GeminiGenerator
@@ -8,6 +16,75 @@ from .llm_generator import GeminiGenerator
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Bump when segmentation, chunking or the saved index layout changes, so
+# cached artifacts built by older code are not loaded
+ARTIFACT_VERSION = 1
+
+# Question categories in precedence order; each is one substring alternation
+# (same matching as `keyword in question_lower`), scanned by the regex engine in C
+_QUESTION_TYPE_PATTERNS = tuple(
+    (question_type, re.compile("|".join(re.escape(keyword) for keyword in keywords)))
+    for question_type, keywords in (
+        ("overview", [
+            "overview", "summary", "introduction", "what is", "explain",
+            "describe", "tell me about", "background"
+        ]),
+        ("detail", [
+            "specific", "detail", "exact", "precise", "section",
+            "subsection", "clause", "paragraph", "line"
+        ]),
+        ("comparison", [
+            "compare", "difference", "similar", "versus", "vs",
+            "contrast", "relationship between"
+        ]),
+    )
+)
+
+# Answer instructions per question type
+_INSTRUCTIONS = {
+    "overview": (
+        "Provide a comprehensive overview based on the higher-level sections. "
+        "Focus on main themes, structure, and key points. "
+        "Synthesize information from multiple related sections."
+    ),
+    "detail": (
+        "Provide precise, detailed information. "
+        "Reference specific sections, subsections, or clauses when possible. "
+        "Include exact requirements, specifications, or conditions."
+    ),
+    "comparison": (
+        "Compare and contrast different sections or requirements. "
+        "Highlight similarities and differences clearly. "
+        "Organize your answer to show comparisons systematically."
+    ),
+}
+_DEFAULT_INSTRUCTIONS = (
+    "Answer based on the most relevant sections. "
+    "If the context provides clear information, base your answer on it. "
+    "Otherwise, acknowledge the limitations."
+)
+
+_PROMPT_TEMPLATE = (
+    "You are a knowledgeable assistant answering questions about regulatory documents.\n\n"
+    "The following context is organized hierarchically (indentation shows document structure):\n"
+    "{context}\n\n"
+    "Question type: {question_type}\n"
+    "Question: {question}\n\n"
+    "{instructions}\n\nAnswer:"
+)
+
+
+@dataclass(slots=True)
+class Source:
+    """Source entry for an answer; converted with asdict() before it leaves the pipeline"""
+    chunk_id: str
+    text_preview: str
+    similarity: float
+    depth: int
+    level: Union[int, str]
+    parent_chunks: int
+    child_chunks: int
+
 
 class EnhancedRAGPipeline:
     """
@@ -18,12 +95,32 @@ class EnhancedRAGPipeline:
         self,
         content_path: str,
         content_type: str = "pdf",
-        model_name: str = "gemini-2.5-flash-lite"
+        model_name: str = "gemini-2.5-flash-lite",
+        force_rebuild: bool = False,
+        cache_dir: str = "data/processed"
     ):
         self.processor = AdvancedDataProcessor(content_path, content_type)
         self.retriever = HierarchicalRetriever()
         self.generator = GeminiGenerator(model_name)
         
+        # Artifacts are keyed by the content, the pipeline version and the encoder, so an
+        # unchanged document skips segmentation and embedding entirely on the next start
+        artifact_dir = Path(cache_dir) / self._content_digest(
+            content_path, content_type, self.retriever.model_name
+        )
+        # Latest hierarchy for visualization/debugging, next to the artifact dirs
+        hierarchy_path = Path(cache_dir) / "hierarchy.json"
+        hierarchy_path.parent.mkdir(parents=True, exist_ok=True)
+        if not force_rebuild and self._manifest_matches(artifact_dir / "manifest.json"):
+            logger.info(f"Loading cached index from {artifact_dir}")
+            self.retriever.load_index(str(artifact_dir))
+            self.chunks = self.retriever.chunks
+            # Only the retriever is restored: self.processor.nodes stays empty on a cache
+            # hit, since the saved hierarchy truncates node text
+            shutil.copyfile(artifact_dir / "hierarchy.json", hierarchy_path)
+            logger.info(f"Loaded {len(self.chunks)} logical chunks")
+            return
+        
         # Process content
         logger.info("Processing content with logical segmentation...")
         if content_type.lower() == "pdf":
@@ -40,7 +137,42 @@ class EnhancedRAGPipeline:
         self.retriever.create_multi_level_embeddings(self.chunks)
         
         # Save hierarchy for visualization/debugging
-        self.processor.save_hierarchy("data/processed/hierarchy.json")
+        self.processor.save_hierarchy(str(hierarchy_path))
+        
+        # Manifest is written last, so a partially written artifact is never loaded
+        self.retriever.save_index(str(artifact_dir))
+        shutil.copyfile(hierarchy_path, artifact_dir / "hierarchy.json")
+        (artifact_dir / "manifest.json").write_bytes(orjson.dumps({
+            "content_path": content_path,
+            "content_type": content_type,
+            "artifact_version": ARTIFACT_VERSION,
+            "embedding_model": self.retriever.model_name,
+            "chunk_count": len(self.chunks)
+        }))
+    
+    @staticmethod
+    def _content_digest(content_path: str, content_type: str, embedding_model: str) -> str:
+        """Short digest of the document bytes, how they are parsed and how they are embedded"""
+        digest = hashlib.blake2b(
+            f"{ARTIFACT_VERSION}\0{content_type.lower()}\0{embedding_model}\0".encode(), digest_size=8
+        )
+        with open(content_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+    
+    def _manifest_matches(self, manifest_path: Path) -> bool:
+        """True if a complete artifact exists and was built by this pipeline version and encoder"""
+        if not manifest_path.exists():
+            return False
+        try:
+            manifest = orjson.loads(manifest_path.read_bytes())
+        except orjson.JSONDecodeError:
+            return False
+        return (
+            manifest.get("artifact_version") == ARTIFACT_VERSION
+            and manifest.get("embedding_model") == self.retriever.model_name
+        )
     
     def answer_question(
         self,
@@ -52,6 +184,60 @@ class EnhancedRAGPipeline:
         """
         Answer question using hierarchical retrieval
         """
+        question_type, strategy, retrieved_results = self._retrieve(question, k, threshold, retrieval_strategy)
+        
+        if not retrieved_results:
+            return self._no_results(strategy, question_type)
+        
+        # Generate answer with enhanced prompt
+        prompt = self._build_prompt(retrieved_results, question, question_type)
+        answer = self.generator.generate(prompt)
+        
+        return {
+            "answer": answer,
+            "sources": self._extract_sources(retrieved_results),
+            "retrieval_strategy": strategy,
+            "question_type": question_type,
+            "chunks_retrieved": len(retrieved_results)
+        }
+    
+    async def answer_question_async(
+        self,
+        question: str,
+        k: int = 5,
+        threshold: float = 0.25,
+        retrieval_strategy: str = "hybrid"
+    ) -> Dict:
+        """
+        Async answer_question(): retrieval runs in a worker thread and the Gemini call on the
+        async client, so several questions can be in flight on one event loop
+        """
+        question_type, strategy, retrieved_results = await asyncio.to_thread(
+            self._retrieve, question, k, threshold, retrieval_strategy
+        )
+        
+        if not retrieved_results:
+            return self._no_results(strategy, question_type)
+        
+        prompt = self._build_prompt(retrieved_results, question, question_type)
+        answer = await self.generator.agenerate(prompt)
+        
+        return {
+            "answer": answer,
+            "sources": self._extract_sources(retrieved_results),
+            "retrieval_strategy": strategy,
+            "question_type": question_type,
+            "chunks_retrieved": len(retrieved_results)
+        }
+    
+    def _retrieve(
+        self,
+        question: str,
+        k: int,
+        threshold: float,
+        retrieval_strategy: str
+    ) -> Tuple[str, str, List[RetrievalResult]]:
+        """Classify the question, pick the strategy and run hierarchical retrieval"""
         # Classify question type
         question_type = self._classify_question(question)
         
@@ -75,94 +261,69 @@ class EnhancedRAGPipeline:
         
         logger.info(f"Retrieved {len(retrieved_results)} chunks using {strategy} strategy")
         
-        if not retrieved_results:
-            return {
-                "answer": "No relevant information found in the document.",
-                "sources": [],
-                "retrieval_strategy": strategy,
-                "question_type": question_type
-            }
-        
-        # Format context with hierarchy information
-        context = self._format_hierarchical_context(retrieved_results, question_type)
-        
-        # Generate answer with enhanced prompt
-        prompt = self._create_enhanced_prompt(context, question, question_type)
-        answer = self.generator.generate(prompt)
-        
-        # Extract sources with hierarchy information
-        sources = []
-        for result in retrieved_results:
-            source_info = {
-                "chunk_id": result.chunk_id,
-                "text_preview": result.text[:200] + "..." if len(result.text) > 200 else result.text,
-                "similarity": result.similarity,
-                "depth": result.depth,
-                "level": result.metadata.get("level", "unknown"),
-                "parent_chunks": len(result.parent_chunks),
-                "child_chunks": len(result.child_chunks)
-            }
-            sources.append(source_info)
-        
+        return question_type, strategy, retrieved_results
+    
+    @staticmethod
+    def _no_results(strategy: str, question_type: str) -> Dict:
         return {
-            "answer": answer,
-            "sources": sources,
+            "answer": "No relevant information found in the document.",
+            "sources": [],
             "retrieval_strategy": strategy,
-            "question_type": question_type,
-            "chunks_retrieved": len(retrieved_results)
+            "question_type": question_type
         }
     
+    def _build_prompt(self, retrieved_results: List[RetrievalResult], question: str, question_type: str) -> str:
+        # Format context with hierarchy information
+        context = self._format_hierarchical_context(retrieved_results, question_type)
+        return self._create_enhanced_prompt(context, question, question_type)
+    
+    @staticmethod
+    def _extract_sources(retrieved_results: List[RetrievalResult]) -> List[Dict]:
+        """Extract sources with hierarchy information"""
+        # Callers index and JSON-encode the sources, so hand them plain dicts
+        return [
+            asdict(Source(
+                result.chunk_id,
+                result.text_preview,
+                result.similarity,
+                result.depth,
+                result.metadata.get("level", "unknown"),
+                len(result.parent_chunks),
+                len(result.child_chunks)
+            ))
+            for result in retrieved_results
+        ]
+    
     def _classify_question(self, question: str) -> str:
         """Classify question type to determine retrieval strategy"""
+        return self._classify_question_cached(question)
+    
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def _classify_question_cached(question: str) -> str:
+        """Memoized classifier; pure in question"""
         question_lower = question.lower()
         
-        # Overview questions
-        overview_keywords = [
-            "overview", "summary", "introduction", "what is", "explain",
-            "describe", "tell me about", "background"
-        ]
-        
-        # Detail questions
-        detail_keywords = [
-            "specific", "detail", "exact", "precise", "section",
-            "subsection", "clause", "paragraph", "line"
-        ]
-        
-        # Comparison questions
-        comparison_keywords = [
-            "compare", "difference", "similar", "versus", "vs",
-            "contrast", "relationship between"
-        ]
-        
-        for keyword in overview_keywords:
-            if keyword in question_lower:
-                return "overview"
-        
-        for keyword in detail_keywords:
-            if keyword in question_lower:
-                return "detail"
-        
-        for keyword in comparison_keywords:
-            if keyword in question_lower:
-                return "comparison"
+        for question_type, pattern in _QUESTION_TYPE_PATTERNS:
+            if pattern.search(question_lower):
+                return question_type
         
         return "general"
     
     def _format_hierarchical_context(self, results: List[RetrievalResult], question_type: str) -> str:
         """Format retrieved chunks with hierarchy information"""
         context_parts = []
+        include_parents = question_type == "overview"
+        include_children = question_type == "detail"
         
-        for i, result in enumerate(results):
+        for result in results:
             # Add hierarchy indicator
             indent = "  " * result.depth
             level_indicator = f"[Level {result.metadata.get('level', '?')}]"
             
             # Include parent context for overview questions
-            if question_type == "overview" and result.parent_chunks:
-                parent_context = "\n".join([
-                    f"  Parent: {p['text'][:100]}..." 
-                    for p in result.parent_chunks[:2]
-                ])
+            if include_parents and result.parent_previews:
+                parent_context = "\n".join([f"  Parent: {preview}..." for preview in result.parent_previews])
                 context_parts.append(f"{indent}{level_indicator} (Context from parent sections)")
                 context_parts.append(parent_context)
             
@@ -170,11 +331,8 @@ class EnhancedRAGPipeline:
             context_parts.append(f"{indent}{level_indicator} {result.text}")
             
             # Include relevant children for detail questions
-            if question_type == "detail" and result.child_chunks:
-                child_context = "\n".join([
-                    f"    • {c['text'][:150]}..." 
-                    for c in result.child_chunks[:3]
-                ])
+            if include_children and result.child_previews:
+                child_context = "\n".join([f"    • {preview}..." for preview in result.child_previews])
                 context_parts.append(f"{indent}  Relevant details:")
                 context_parts.append(child_context)
             
@@ -189,39 +347,9 @@ class EnhancedRAGPipeline:
         question_type: str
     ) -> str:
         """Create enhanced prompt based on question type and hierarchy"""
-        
-        base_prompt = (
-            "You are a knowledgeable assistant answering questions about regulatory documents.\n\n"
-            "The following context is organized hierarchically (indentation shows document structure):\n"
-            f"{context}\n\n"
-            "Question type: {question_type}\n"
-            "Question: {question}\n\n"
-        )
-        
-        # Add specific instructions based on question type
-        if question_type == "overview":
-            instructions = (
-                "Provide a comprehensive overview based on the higher-level sections. "
-                "Focus on main themes, structure, and key points. "
-                "Synthesize information from multiple related sections."
-            )
-        elif question_type == "detail":
-            instructions = (
-                "Provide precise, detailed information. "
-                "Reference specific sections, subsections, or clauses when possible. "
-                "Include exact requirements, specifications, or conditions."
-            )
-        elif question_type == "comparison":
-            instructions = (
-                "Compare and contrast different sections or requirements. "
-                "Highlight similarities and differences clearly. "
-                "Organize your answer to show comparisons systematically."
-            )
-        else:
-            instructions = (
-                "Answer based on the most relevant sections. "
-                "If the context provides clear information, base your answer on it. "
-                "Otherwise, acknowledge the limitations."
-            )
-        
-        return base_prompt + instructions + "\n\nAnswer:"
\ No newline at end of file
+        return _PROMPT_TEMPLATE.format_map({
+            "context": context,
+            "question_type": question_type,
+            "question": question,
+            "instructions": _INSTRUCTIONS.get(question_type, _DEFAULT_INSTRUCTIONS)
+        })
@@ -1,13 +1,50 @@
 # src/simple_hierarchical_retriever.py (UPDATED)
-import json
+import math
+import threading
+import zipfile
 import numpy as np
+import orjson
 from typing import List, Dict, Tuple, Optional
 import faiss
 from sentence_transformers import SentenceTransformer
-from collections import defaultdict
+from collections import OrderedDict
 from dataclasses import dataclass, asdict
+from heapq import nlargest
+from operator import attrgetter
 from pathlib import Path
 
+# HNSW graph parameters: neighbours per node, build-time and minimum query-time beam widths
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+
+# IVF-PQ (index_type="ivfpq"): 48 sub-quantizers x 8 bits = 48-byte codes; each PQ
+# codebook needs ~39 training points per centroid, so small corpora stay on HNSW
+IVFPQ_M = 48
+IVFPQ_NBITS = 8
+IVFPQ_MIN_TRAIN_PER_CENTROID = 39
+
+QUERY_CACHE_SIZE = 1024
+
+# Dynamically int8-quantized ONNX export (AVX-512 VNNI kernels) shipped in the MiniLM model repo
+INT8_ONNX_FILE = "onnx/model_qint8_avx512_vnni.onnx"
+
+
+def _load_encoder(model_name: str, encoder_backend: str) -> SentenceTransformer:
+    """
+    Load the sentence-transformer for encoder_backend ("torch" or "onnx-int8").
+    onnx-int8 needs sentence-transformers>=3.2 with optimum[onnxruntime]; without
+    them (or without the quantized file) it falls back to the fp32 torch model.
+    """
+    if encoder_backend == "onnx-int8":
+        try:
+            return SentenceTransformer(model_name, backend="onnx", model_kwargs={"file_name": INT8_ONNX_FILE})
+        except Exception as e:
+            print(f"int8 ONNX encoder unavailable ({e}); using the torch model")
+    elif encoder_backend != "torch":
+        raise ValueError(f"Unknown encoder_backend: {encoder_backend}")
+    return SentenceTransformer(model_name)
+
 @dataclass
 class HierarchicalResult:
     """Result with hierarchy information"""
@@ -24,46 +61,141 @@ class SimpleHierarchicalRetriever:
     Simplified hierarchical retriever for HTML content
     """
     
-    def __init__(self, model_name: str = "sentence-transformers/all-MiniLM-L6-v2"):
-        self.model = SentenceTransformer(model_name)
-        self.index: Optional[faiss.IndexFlatIP] = None
+    def __init__(
+        self,
+        model_name: str = "sentence-transformers/all-MiniLM-L6-v2",
+        model: Optional[SentenceTransformer] = None,
+        encoder_backend: str = "torch",
+        index_type: str = "hnsw"  # flat, hnsw, ivfpq
+    ):
+        # An already-loaded model can be shared instead of loading model_name;
+        # indexes should be queried with the same backend they were built with
+        self.model = model if model is not None else _load_encoder(model_name, encoder_backend)
+        if index_type not in ("flat", "hnsw", "ivfpq"):
+            raise ValueError(f"Unknown index_type: {index_type}")
+        self.index_type = index_type
+        self.index: Optional[faiss.Index] = None
         self.chunks: List[Dict] = []
         self.chunk_map: Dict[str, Dict] = {}
-        self.parent_map: Dict[str, str] = {}  # child_id -> parent_id
-        self.child_map: Dict[str, List[str]] = defaultdict(list)  # parent_id -> child_ids
+        # Hierarchy over chunk rows: parent row (-1 for none) and CSR child lists, children of
+        # row r being children_indices[children_indptr[r]:children_indptr[r + 1]] in chunk order
+        self.parent_row: Optional[np.ndarray] = None
+        self.children_indptr: Optional[np.ndarray] = None
+        self.children_indices: Optional[np.ndarray] = None
+        self.embeddings: Optional[np.ndarray] = None  # normalized rows, aligned with self.chunks
+        self.id_to_row: Dict[str, int] = {}
+        # Normalized query rows by query text; the lock covers sessions and the batching thread
+        self._query_cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._query_cache_lock = threading.Lock()
         
         self.dimension = self.model.get_sentence_embedding_dimension()
     
-    @staticmethod
-    def _normalize(x: np.ndarray) -> None:
-        """Normalize embeddings for cosine similarity"""
-        faiss.normalize_L2(x)
+    def _encode(self, texts: List[str], batch_size: int = 32, show_progress_bar: bool = False) -> np.ndarray:
+        """Encode texts to L2-normalized float32 rows (normalization happens inside encode)"""
+        embeddings = self.model.encode(
+            texts,
+            batch_size=batch_size,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=show_progress_bar,
+        )
+        return embeddings.astype(np.float32, copy=False)
+    
+    def _embed_queries(self, queries: List[str]) -> np.ndarray:
+        """Normalized (n, d) query embeddings; only queries missing from the LRU are encoded, in one call"""
+        with self._query_cache_lock:
+            rows = [self._query_cache.get(query) for query in queries]
+            for query, row in zip(queries, rows):
+                if row is not None:
+                    self._query_cache.move_to_end(query)
+        
+        misses = list(dict.fromkeys(query for query, row in zip(queries, rows) if row is None))
+        if misses:
+            misses_np = self._encode(misses, batch_size=len(misses))
+            misses_np.setflags(write=False)  # rows are shared through the cache
+            encoded = dict(zip(misses, misses_np))
+            rows = [encoded[query] if row is None else row for query, row in zip(queries, rows)]
+            
+            with self._query_cache_lock:
+                self._query_cache.update(encoded)
+                while len(self._query_cache) > QUERY_CACHE_SIZE:
+                    self._query_cache.popitem(last=False)
+        
+        return np.stack(rows)
+    
+    def clear_query_cache(self) -> None:
+        with self._query_cache_lock:
+            self._query_cache.clear()
+    
+    def _new_index(self, embeddings_np: np.ndarray) -> faiss.Index:
+        """Empty, trained index of self.index_type; inner product on normalized rows is cosine similarity"""
+        if self.index_type == "flat":
+            return faiss.IndexFlatIP(self.dimension)
+        
+        if self.index_type == "ivfpq":
+            n = len(embeddings_np)
+            nlist = max(64, int(4 * math.sqrt(n)))
+            if n >= IVFPQ_MIN_TRAIN_PER_CENTROID * max(nlist, 2 ** IVFPQ_NBITS):
+                quantizer = faiss.IndexFlatIP(self.dimension)
+                index = faiss.IndexIVFPQ(
+                    quantizer, self.dimension, nlist, IVFPQ_M, IVFPQ_NBITS, faiss.METRIC_INNER_PRODUCT
+                )
+                index.train(embeddings_np)
+                return index
+            print(f"Only {n} chunks, too few to train IVF-PQ; using HNSW")
+        
+        index = faiss.IndexHNSWFlat(self.dimension, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+        return index
+    
+    def _search(self, queries_np: np.ndarray, n: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Top-n search. HNSW gets a beam at least n wide and IVF probes 1/16 of its lists;
+        both are passed per call so concurrent searches don't race
+        """
+        params = None
+        if isinstance(self.index, faiss.IndexHNSW):
+            params = faiss.SearchParametersHNSW(efSearch=max(HNSW_EF_SEARCH, n))
+        elif isinstance(self.index, faiss.IndexIVF):
+            params = faiss.SearchParametersIVF(nprobe=max(8, self.index.nlist // 16))
+        return self.index.search(queries_np, n, params=params)
+    
+    def _build_hierarchy_arrays(self) -> None:
+        """Parent rows and CSR child lists from each chunk's metadata parent_id"""
+        n = len(self.chunks)
+        self.parent_row = np.fromiter(
+            (self.id_to_row.get(chunk["metadata"].get("parent_id"), -1) for chunk in self.chunks),
+            dtype=np.int32, count=n
+        )
+        
+        # Child rows grouped by parent; the stable sort keeps chunk order within each group
+        child_rows = np.flatnonzero(self.parent_row >= 0)
+        parents = self.parent_row[child_rows]
+        self.children_indices = child_rows[np.argsort(parents, kind="stable")].astype(np.int32)
+        self.children_indptr = np.zeros(n + 1, dtype=np.int32)
+        np.cumsum(np.bincount(parents, minlength=n), out=self.children_indptr[1:])
     
     def create_embeddings(self, chunks: List[Dict]) -> np.ndarray:
-        """Create embeddings and build hierarchy maps"""
+        """Create embeddings and build hierarchy arrays"""
         self.chunks = chunks
         self.chunk_map = {chunk["chunk_id"]: chunk for chunk in chunks}
-        
-        # Build hierarchy maps
-        for chunk in chunks:
-            parent_id = chunk["metadata"].get("parent_id")
-            if parent_id:
-                self.parent_map[chunk["chunk_id"]] = parent_id
-                self.child_map[parent_id].append(chunk["chunk_id"])
+        self.id_to_row = {chunk["chunk_id"]: i for i, chunk in enumerate(chunks)}
+        self._build_hierarchy_arrays()
         
         # Create embeddings
         texts = [chunk["text"] for chunk in chunks]
-        embeddings = self.model.encode(texts, show_progress_bar=True)
-        embeddings_np = np.asarray(embeddings, dtype=np.float32)
+        embeddings_np = self._encode(texts, batch_size=64, show_progress_bar=True)
         
-        self._normalize(embeddings_np)
+        # Kept for scoring children without re-encoding them
+        self.embeddings = embeddings_np
         
         # Create FAISS index
-        self.index = faiss.IndexFlatIP(self.dimension)
+        self.index = self._new_index(embeddings_np)
         self.index.add(embeddings_np)
         
         print(f"Created embeddings for {len(chunks)} chunks")
-        print(f"Hierarchy: {len(self.parent_map)} parent-child relationships")
+        print(f"Hierarchy: {len(self.children_indices)} parent-child relationships")
         
         return embeddings_np
     
@@ -81,18 +213,127 @@ class SimpleHierarchicalRetriever:
         if self.index is None:
             raise RuntimeError("Index not initialized")
         
-        # Encode query
-        query_embedding = self.model.encode([query])
-        query_np = np.asarray(query_embedding, dtype=np.float32)
-        self._normalize(query_np)
+        # Encode query (cached)
+        query_np = self._embed_queries([query])
         
         # Search
-        scores, indices = self.index.search(query_np, min(k * 3, len(self.chunks)))
+        scores, indices = self._search(query_np, min(k * 3, len(self.chunks)))
         
+        return self._collect_results(
+            query_np, scores[0], indices[0], k, threshold, include_parent, include_children
+        )
+    
+    def retrieve_with_history(
+        self,
+        query: str,
+        history: List[str],
+        k: int = 5,
+        threshold: float = 0.25,
+        include_parent: bool = True,
+        include_children: bool = False,
+        history_weight: float = 0.8
+    ) -> List[HierarchicalResult]:
+        """
+        Retrieve for a query plus the last few prior turns with one encode and
+        one FAISS search. Each chunk keeps its best score across the queries;
+        prior-turn scores are scaled by history_weight so the current
+        question dominates.
+        """
+        if self.index is None:
+            raise RuntimeError("Index not initialized")
+        
+        queries = [query] + list(history[-3:])
+        queries_np = self._embed_queries(queries)
+        
+        n = min(k * 3, len(self.chunks))
+        scores, indices = self._search(queries_np, n)
+        scores[1:] *= history_weight
+        
+        # Max-score fusion: best score per chunk, highest first
+        flat_scores = scores.ravel()
+        flat_indices = indices.ravel()
+        order = np.argsort(-flat_scores, kind="stable")
+        flat_scores, flat_indices = flat_scores[order], flat_indices[order]
+        _, first = np.unique(flat_indices, return_index=True)
+        first.sort()
+        
+        return self._collect_results(
+            queries_np[:1], flat_scores[first][:n], flat_indices[first][:n],
+            k, threshold, include_parent, include_children
+        )
+    
+    def retrieve_with_context_batch(
+        self,
+        queries: List[str],
+        kwargs_list: List[Dict]
+    ) -> List[List[HierarchicalResult]]:
+        """
+        Retrieve for several queries with one encode and one FAISS search.
+        kwargs_list[i] holds the retrieve_with_context() keyword arguments
+        (k, threshold, include_parent, include_children) for queries[i].
+        """
+        if self.index is None:
+            raise RuntimeError("Index not initialized")
+        if not queries:
+            return []
+        
+        # Encode all uncached queries in one forward pass
+        queries_np = self._embed_queries(queries)
+        
+        # One search wide enough for the largest k in the batch
+        max_k = max(kwargs.get("k", 5) for kwargs in kwargs_list)
+        scores, indices = self._search(queries_np, min(max_k * 3, len(self.chunks)))
+        
+        batch_results = []
+        for i, kwargs in enumerate(kwargs_list):
+            k = kwargs.get("k", 5)
+            n = min(k * 3, len(self.chunks))
+            batch_results.append(self._collect_results(
+                queries_np[i:i + 1],
+                scores[i][:n],
+                indices[i][:n],
+                k,
+                kwargs.get("threshold", 0.25),
+                kwargs.get("include_parent", True),
+                kwargs.get("include_children", False)
+            ))
+        
+        return batch_results
+    
+    def _collect_results(
+        self,
+        query_np: np.ndarray,
+        scores: np.ndarray,
+        indices: np.ndarray,
+        k: int,
+        threshold: float,
+        include_parent: bool,
+        include_children: bool
+    ) -> List[HierarchicalResult]:
+        """Turn one row of FAISS output into results with parent/child context"""
         results = []
         seen_chunks = set()
         
-        for idx, score in zip(indices[0], scores[0]):
+        # Every accepted hit adds at least one result, so at most k hits are expanded; score
+        # the children of the first k distinct hits in one batch instead of one per parent.
+        # A hit skipped below because it was already added as a child frees its slot, so an
+        # accepted hit past these candidates is scored on demand.
+        indptr = self.children_indptr
+        relevant_children: Dict[int, List[Tuple[Dict, float]]] = {}
+        scored_rows = set()
+        if include_children:
+            candidate_rows = []
+            for idx, score in zip(indices, scores):
+                if len(candidate_rows) >= k:
+                    break
+                if idx == -1 or score < threshold or idx >= len(self.chunks):
+                    continue
+                if idx not in candidate_rows and indptr[idx + 1] > indptr[idx]:
+                    candidate_rows.append(idx)
+            relevant_children = self._get_relevant_children_batch(candidate_rows, query_np, threshold * 0.8)
+            scored_rows.update(candidate_rows)
+        
+        for idx, score in zip(indices, scores):
             if idx == -1 or score < threshold or idx >= len(self.chunks):
                 continue
             
@@ -106,10 +347,10 @@ class SimpleHierarchicalRetriever:
             # Get parent context if requested
             parent_text = None
             if include_parent:
-                parent_text = self._get_parent_text(chunk_id)
+                parent_text = self._get_parent_text(idx)
             
             # Get child count
-            child_count = len(self.child_map.get(chunk_id, []))
+            child_count = int(indptr[idx + 1] - indptr[idx])
             
             result = HierarchicalResult(
                 chunk_id=chunk_id,
@@ -125,9 +366,12 @@ class SimpleHierarchicalRetriever:
             
             # Include children if requested
             if include_children and child_count > 0:
-                child_results = self._get_relevant_children(
-                    chunk_id, query_np, threshold * 0.8
-                )
+                if idx not in scored_rows:
+                    relevant_children.update(
+                        self._get_relevant_children_batch([idx], query_np, threshold * 0.8)
+                    )
+                    scored_rows.add(idx)
+                child_results = relevant_children.get(idx, [])
                 for child_chunk, child_score in child_results[:2]:  # Top 2 children
                     if child_chunk["chunk_id"] not in seen_chunks:
                         results.append(HierarchicalResult(
@@ -143,17 +387,15 @@ class SimpleHierarchicalRetriever:
             if len(results) >= k:
                 break
         
-        # Sort by similarity
-        results.sort(key=lambda x: x.similarity, reverse=True)
-        return results[:k]
+        # Top k by similarity (partial selection; stable like the full sort it replaces)
+        return nlargest(k, results, key=attrgetter("similarity"))
     
-    def _get_parent_text(self, chunk_id: str) -> Optional[str]:
-        """Get text of parent chunk"""
-        parent_id = self.parent_map.get(chunk_id)
-        if parent_id and parent_id in self.chunk_map:
-            parent_chunk = self.chunk_map[parent_id]
+    def _get_parent_text(self, row: int) -> Optional[str]:
+        """Get text of the parent chunk of a chunk row"""
+        parent = self.parent_row[row]
+        if parent >= 0:
             # Return truncated parent text
-            text = parent_chunk["text"]
+            text = self.chunks[parent]["text"]
             return text[:150] + "..." if len(text) > 150 else text
         return None
     
@@ -164,37 +406,44 @@ class SimpleHierarchicalRetriever:
         threshold: float
     ) -> List[Tuple[Dict, float]]:
         """Get relevant children of a chunk"""
-        child_ids = self.child_map.get(parent_id, [])
-        if not child_ids:
-            return []
-        
-        # Get child chunks
-        child_chunks = []
-        for child_id in child_ids:
-            if child_id in self.chunk_map:
-                child_chunks.append(self.chunk_map[child_id])
-        
-        if not child_chunks:
+        row = self.id_to_row.get(parent_id)
+        if row is None:
             return []
+        return self._get_relevant_children_batch([row], query_embedding, threshold).get(row, [])
+    
+    def _get_relevant_children_batch(
+        self,
+        parent_rows: List[int],
+        query_embedding: np.ndarray,
+        threshold: float
+    ) -> Dict[int, List[Tuple[Dict, float]]]:
+        """Relevant children of several chunk rows, scored from the stored chunk embeddings"""
+        # Child rows of every parent, concatenated; offsets[i] marks where parent i starts
+        indptr = self.children_indptr
+        spans = [self.children_indices[indptr[row]:indptr[row + 1]] for row in parent_rows]
+        child_rows = np.concatenate(spans) if spans else self.children_indices[:0]
+        if not len(child_rows):
+            return {}
+        offsets = np.zeros(len(spans) + 1, dtype=np.int64)
+        np.cumsum([len(span) for span in spans], out=offsets[1:])
+        child_chunks = [self.chunks[row] for row in child_rows]
         
         # Score children against query
-        child_texts = [chunk["text"] for chunk in child_chunks]
-        child_embeddings = self.model.encode(child_texts)
-        child_embeddings_np = np.asarray(child_embeddings, dtype=np.float32)
-        self._normalize(child_embeddings_np)
-        
-        # Calculate similarities
-        similarities = np.dot(child_embeddings_np, query_embedding.T).flatten()
-        
-        # Pair chunks with scores and filter
-        results = []
-        for chunk, similarity in zip(child_chunks, similarities):
-            if similarity >= threshold:
-                results.append((chunk, float(similarity)))
+        similarities = (self.embeddings[child_rows] @ query_embedding.T).ravel()
         
-        # Sort by similarity
-        results.sort(key=lambda x: x[1], reverse=True)
-        return results
+        relevant = {}
+        for row, start, end in zip(parent_rows, offsets, offsets[1:]):
+            # Pair chunks with scores and filter
+            results = [
+                (chunk, float(similarity))
+                for chunk, similarity in zip(child_chunks[start:end], similarities[start:end])
+                if similarity >= threshold
+            ]
+            if results:
+                # Sort by similarity
+                results.sort(key=lambda x: x[1], reverse=True)
+                relevant[row] = results
+        return relevant
     
     def save_index(self, index_path: str, chunks_path: str, hierarchy_path: str = None) -> None:
         """Save index, chunks, and hierarchy"""
@@ -204,21 +453,22 @@ class SimpleHierarchicalRetriever:
         # Create directories
         Path(index_path).mkdir(parents=True, exist_ok=True)
         
-        # Save FAISS index
+        # Save FAISS index and the raw embedding rows (loaded back memory-mapped)
         faiss.write_index(self.index, f"{index_path}/index.faiss")
+        np.save(f"{index_path}/embeddings.npy", self.embeddings)
         
         # Save chunks
-        with open(chunks_path, "w", encoding="utf-8") as f:
-            json.dump(self.chunks, f, indent=2, ensure_ascii=False)
+        Path(chunks_path).write_bytes(orjson.dumps(self.chunks))
         
-        # Save hierarchy if requested
+        # Save hierarchy arrays if requested (written through a handle so the name is kept as given)
         if hierarchy_path:
-            hierarchy_data = {
-                "parent_map": self.parent_map,
-                "child_map": dict(self.child_map)
-            }
-            with open(hierarchy_path, "w", encoding="utf-8") as f:
-                json.dump(hierarchy_data, f, indent=2, ensure_ascii=False)
+            with open(hierarchy_path, "wb") as f:
+                np.savez(
+                    f,
+                    parent_row=self.parent_row,
+                    children_indptr=self.children_indptr,
+                    children_indices=self.children_indices
+                )
         
         print(f"Saved index to {index_path}")
         print(f"Saved chunks to {chunks_path}")
@@ -231,24 +481,25 @@ class SimpleHierarchicalRetriever:
         self.index = faiss.read_index(f"{index_path}/index.faiss")
         
         # Load chunks
-        with open(chunks_path, "r", encoding="utf-8") as f:
-            self.chunks = json.load(f)
+        self.chunks = orjson.loads(Path(chunks_path).read_bytes())
         self.chunk_map = {chunk["chunk_id"]: chunk for chunk in self.chunks}
+        self.id_to_row = {chunk["chunk_id"]: i for i, chunk in enumerate(self.chunks)}
+        
+        # Embedding rows: memory-mapped when saved alongside the index, else read back out of it
+        embeddings_path = Path(f"{index_path}/embeddings.npy")
+        if embeddings_path.exists():
+            self.embeddings = np.load(embeddings_path, mmap_mode="r")
+        else:
+            self.embeddings = self.index.reconstruct_n(0, self.index.ntotal)
         
-        # Load hierarchy if available
-        if hierarchy_path and Path(hierarchy_path).exists():
-            with open(hierarchy_path, "r", encoding="utf-8") as f:
-                hierarchy_data = json.load(f)
-            self.parent_map = hierarchy_data.get("parent_map", {})
-            self.child_map = defaultdict(list, hierarchy_data.get("child_map", {}))
+        # Load hierarchy arrays if available; older JSON hierarchy maps are not .npz archives
+        if hierarchy_path and Path(hierarchy_path).exists() and zipfile.is_zipfile(hierarchy_path):
+            with np.load(hierarchy_path) as hierarchy_data:
+                self.parent_row = hierarchy_data["parent_row"]
+                self.children_indptr = hierarchy_data["children_indptr"]
+                self.children_indices = hierarchy_data["children_indices"]
         else:
             # Rebuild hierarchy from chunks
-            self.parent_map = {}
-            self.child_map = defaultdict(list)
-            for chunk in self.chunks:
-                parent_id = chunk["metadata"].get("parent_id")
-                if parent_id:
-                    self.parent_map[chunk["chunk_id"]] = parent_id
-                    self.child_map[parent_id].append(chunk["chunk_id"])
+            self._build_hierarchy_arrays()
         
         print(f"Loaded index with {len(self.chunks)} chunks")
\ No newline at end of file